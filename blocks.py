@@ -2,6 +2,8 @@
 import pygame as pg
 import utils
 import random
+import numpy as np
+from collections import OrderedDict
 pg.init()
 
 SPRITES = { # misc sprites
@@ -18,6 +20,55 @@ for key in waterdict.keys():
     tempsurface.blit(waterdict[key], (0, 0))
     waterdict[key] = tempsurface
 
+class SpriteCache():
+    """Scaled tile sprites shared between every tile that looks the same,
+    keyed by (group, sprite name, size). The least recently used sprite is
+    dropped once there are more than maxsize. Sprites are shared, so copy
+    one before drawing on it."""
+    def __init__(self, maxsize=1024):
+        self.sprites = OrderedDict()
+        self.maxsize = maxsize
+
+    def get(self, group, name, size, spritedict) -> "Surface":
+        """Returns spritedict[name] scaled to size, scaling it only once."""
+        key = (group, name, size)
+        if key in self.sprites:
+            self.sprites.move_to_end(key)
+            return self.sprites[key]
+        sprite = pg.transform.scale(spritedict[name], (size, size))
+        self.sprites[key] = sprite
+        if len(self.sprites) > self.maxsize:
+            self.sprites.popitem(last=False)
+        return sprite
+
+spritecache = SpriteCache()
+# 47 sprites per group at most, so this rarely evicts anything
+
+NEIGHBOURS = ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1))
+# (x, y) of each digit of a sprite name, see Block.choose_sprite()
+MASKNAMES = [format(mask, "08b") for mask in range(256)]
+# sprite name of each mask, the first digit being the highest bit
+
+def neighbour_masks(groups) -> "2D Array":
+    """Works out the sprite of every tile in a level at once, the same way
+    as Block.choose_sprite(). Takes a 2D array of group ids, one per tile,
+    and returns a mask per tile with a bit set for each neighbour that is
+    in another group or off the map. MASKNAMES turns a mask into the name
+    of the sprite.
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    height, width = groups.shape
+    padded = np.full((height + 2, width + 2), -1, dtype=np.int64)
+    padded[1:-1, 1:-1] = groups
+    bits = [padded[1 + y:height + 1 + y, 1 + x:width + 1 + x] != groups for x, y in NEIGHBOURS]
+    for corner, first, second in ((0, 1, 3), (2, 1, 4), (5, 3, 6), (7, 4, 6)):
+        bits[corner] = bits[corner] | bits[first] | bits[second]
+        # a corner only counts as the same when both sides next to it are
+    masks = np.zeros((height, width), dtype=np.uint8)
+    for i, bit in enumerate(bits):
+        masks[bit] |= 128 >> i
+    return masks
+
 class Block():
     """Any tile that inherits from this class will have a choose_sprite method"""
     def choose_sprite(self, position, layout, size):
@@ -63,7 +114,12 @@ class Block():
         if info[6] == 1:
             id[5] = 1
             id[7] = 1
-        self.sprite = pg.transform.scale(self.spritedict[str(id).strip("[]").replace(", ", "")], (size, size))
+        self.sprite = spritecache.get(self.group, str(id).strip("[]").replace(", ", ""), size, self.spritedict)
+        self.do_additional_generation(position, layout, size)
+
+    def set_sprite(self, mask, position, layout, size):
+        """Same as choose_sprite(), taking the mask from neighbour_masks()."""
+        self.sprite = spritecache.get(self.group, MASKNAMES[mask], size, self.spritedict)
         self.do_additional_generation(position, layout, size)
 
     def do_additional_generation(self, position, layout, size):
@@ -77,7 +133,7 @@ class Void():
         self.weight = weight
         self.transparent = True
         self.light = 0
-        self.sprite = pg.transform.scale(SPRITES["Void"], (size, size))
+        self.sprite = spritecache.get("Void", "Void", size, SPRITES)
         self.luminous = False
         self.solid = False
 
@@ -88,7 +144,7 @@ class Grass(Block):
         self.transparent = True
         self.group = "Grass"
         self.spritedict = grassdict
-        self.sprite = pg.transform.scale(grassdict["00000000"], (size, size))
+        self.sprite = spritecache.get("Grass", "00000000", size, grassdict)
         self.light = 255
         self.luminous = True
         self.solid = False
@@ -99,6 +155,8 @@ class Grass(Block):
             offset1 = random.randint(-20, 20)
             offset2 = random.randint(-20, 20)
             blittable = random.choice(list(grass_extras_dict.values()))
+            self.sprite = self.sprite.copy()
+            # the undecorated sprite is shared with other tiles
             location = ((self.sprite.get_width() - blittable.get_width()) / 2 + offset1, (self.sprite.get_height() - blittable.get_height()) / 2 + offset2)
             self.sprite.blit(blittable, location)
 
@@ -111,7 +169,7 @@ class Wall(Block):
         self.spritedict = walldict
         self.light = 0
         self.luminous = False
-        self.sprite = pg.transform.scale(walldict["00000000"], (size, size))
+        self.sprite = spritecache.get("Wall", "00000000", size, walldict)
         self.solid = True
         
 
@@ -124,7 +182,7 @@ class CaveFloor(Block):
         self.light = 0
         self.luminous = False
         self.spritedict = cavedict
-        self.sprite = pg.transform.scale(cavedict["00000000"], (size, size))
+        self.sprite = spritecache.get("Cave", "00000000", size, cavedict)
         self.group = "Cave"
         # Group used for tile texture selection
         self.solid = False
@@ -138,6 +196,6 @@ class Water(Block):
         self.light = 255
         self.luminous = True
         self.spritedict = waterdict
-        self.sprite = pg.transform.scale(cavedict["00000000"], (size, size))
+        self.sprite = spritecache.get("Cave", "00000000", size, cavedict)
         self.group = "Water"
         self.solid = False
\ No newline at end of file
@@ -1,31 +1,19 @@
 """Import used by index.py to store all entity objects."""
+import array
 import random
 import pygame as pg
 import math
 import utils
+import pathfinding
+from concurrent.futures import ProcessPoolExecutor
 pg.init()
 
 # General Behaviour of entities:
 # Update methods should always return a list of entities that should continue to be processed for the next frame
+# Update methods are given the level's EntityIndex to look up other entities by tile
 # Pathfinding methods will simply set the next_move attribute according to data given - movement methods still have to be called as needed.
 # Directions are represented using Numpad Notation to avoid string processing: North East South West = 8 6 2 4
 
-def astarlistcheck(current, array):
-    checkx, checky = current[0], current[1]
-    returnvalue = None
-    for element in array:
-        if element[0] == checkx and element[1] == checky:
-            returnvalue = element[2]
-            break
-    return returnvalue
-
-def astarremove(element, array):
-    for i in range(len(list)):
-        if (array[0], array[1], array[2]) == element:
-            array.pop(i)
-            return array
-    return array
-
 class Sprites():
     """Simple class for storing and resizing sprites."""
     def __init__(self):
@@ -72,6 +60,223 @@ class Sprites():
 # global for easy access to all entities
 sprites = Sprites()
 
+class EntityIndex():
+    """Spatial hash of entities keyed by the tile they stand on, so that
+    lookups by position don't have to scan every entity. Also counts the
+    non-walkable entities on each tile in self.occupied.
+    The game loop keeps it up to date by calling move() after an entity
+    may have moved and sync() whenever the entity list is replaced.
+    """
+    def __init__(self):
+        self.tiles = {}
+        # (x, y) -> list of entities on that tile
+        self.positions = {}
+        # entity -> (tile it is filed under, walkable when it was filed)
+        self.occupied = {}
+        # (x, y) -> number of non-walkable entities on that tile
+
+    def add(self, entity):
+        position = (entity.x, entity.y)
+        self.positions[entity] = (position, entity.walkable)
+        self.tiles.setdefault(position, []).append(entity)
+        if not entity.walkable:
+            self.occupied[position] = self.occupied.get(position, 0) + 1
+
+    def remove(self, entity):
+        position, walkable = self.positions.pop(entity)
+        self.tiles[position].remove(entity)
+        if len(self.tiles[position]) == 0:
+            del self.tiles[position]
+        if not walkable:
+            self.occupied[position] -= 1
+            if self.occupied[position] == 0:
+                del self.occupied[position]
+
+    def move(self, entity):
+        """Refiles an entity if it is no longer on the tile it was filed under."""
+        if self.positions[entity][0] != (entity.x, entity.y):
+            self.remove(entity)
+            self.add(entity)
+
+    def sync(self, entities):
+        """Makes the index hold exactly the given entities. Only entities
+        that spawned, moved or died since the last call are refiled.
+        """
+        current = set(entities)
+        for entity in [entity for entity in self.positions if entity not in current]:
+            self.remove(entity)
+        for entity in entities:
+            if entity in self.positions:
+                self.move(entity)
+            else:
+                self.add(entity)
+
+    def at(self, position) -> "List of entities":
+        return self.tiles.get(tuple(position), [])
+
+    def projectiles_at(self, position) -> "List of entities":
+        return [entity for entity in self.at(position) if entity.projectile]
+
+    def in_rect(self, left, top, width, height) -> "List of entities":
+        """Every entity on a tile inside the rectangle."""
+        found = []
+        if width * height <= len(self.tiles):
+            for y in range(top, top + height):
+                for x in range(left, left + width):
+                    found += self.tiles.get((x, y), [])
+        else:
+            for (x, y), tile in self.tiles.items():
+                if left <= x < left + width and top <= y < top + height:
+                    found += tile
+        return found
+
+class PathfindScheduler():
+    """Decides which enemies pathfind this turn, based on how far they are
+    from the player and whether the player can see them. Enemies within
+    near tiles or in view plan every turn, those within far tiles plan
+    every interval turns (staggered so they don't all plan at once), and
+    the rest sleep until the player comes closer. Anything that isn't an
+    enemy, such as a projectile, is always due. Enemies with cheappathfind
+    set, such as Soldiers stepping down the shared flow field and Grunts
+    walking in a straight line, plan every turn unless they are asleep, so
+    they aren't slowed down but the field is only built when one is near.
+    """
+    def __init__(self, near=8, far=24, interval=4):
+        self.near = near
+        self.far = far
+        self.interval = interval
+        self.waited = {}
+        # enemy -> turns since it last planned
+        self.player = None
+        self.level = None
+
+    def start_turn(self, level, player):
+        """Sets where the player is and forgets enemies that are gone.
+        Should be called every turn before due() is asked, and may be
+        called again within a turn if the player moved.
+        """
+        self.player = tuple(player)
+        self.level = level
+        alive = set(level.entities)
+        self.waited = {entity: waited for entity, waited in self.waited.items() if entity in alive}
+
+    def tier(self, entity) -> "String":
+        """Returns "active", "distant" or "asleep"."""
+        distance = max(abs(entity.x - self.player[0]), abs(entity.y - self.player[1]))
+        if distance <= self.near:
+            return "active"
+        if distance > self.far:
+            return "asleep"
+        if self.level.visibility.can_see(self.player, self.far, (entity.x, entity.y)):
+            return "active"
+        return "distant"
+
+    def due(self, entity) -> "Boolean":
+        """Should be asked once per turn for each entity."""
+        if not entity.enemy:
+            return True
+        if entity not in self.waited:
+            self.waited[entity] = len(self.waited) % self.interval
+            # enemies new to the scheduler start at different points to spread the load
+        self.waited[entity] += 1
+        tier = self.tier(entity)
+        if tier == "asleep":
+            return False
+        if tier == "distant" and not entity.cheappathfind and self.waited[entity] < self.interval:
+            return False
+        self.waited[entity] = 0
+        return True
+
+    def plan_turn(self, entity) -> "Boolean":
+        """Asks due() for the entity, and keeps it walking along its old
+        path if it is distant and not due. Returns True if the entity should
+        pathfind this turn.
+        """
+        if self.due(entity):
+            return True
+        if self.tier(entity) == "distant":
+            entity.follow_path()
+        return False
+
+class PathfindPool():
+    """Runs enemy pathfinding in a pool of worker processes so that a
+    turn never waits on it. At the end of a turn, submit() sends a snapshot
+    of the level's weights and blocked tiles along with a request from every
+    due enemy that supports it (see Entity.pathfind_request()). At the start
+    of a later turn, apply() hands back the results of the tasks that have
+    finished, so enemies act on where the player was a turn or more earlier.
+    Tasks still running are left for a later turn instead of being waited
+    on, and their entities aren't sent again until then.
+    With workers set to 1, nothing is sent and Game pathfinds in place.
+    """
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.executor = None
+        self.pending = []
+        # (entities, positions, future) for every task not yet applied
+
+    def handles(self, entity) -> "Boolean":
+        """Checks if the entity's pathfinding is done by the pool."""
+        return self.workers > 1 and type(entity).pathfind_request is not Entity.pathfind_request
+
+    def submit(self, level, target, scheduler):
+        if self.workers <= 1:
+            return
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        weights = array.array("i", [weight for row in level.solidmap for weight in row])
+        blocked = frozenset(level.occupied)
+        target = tuple(target)
+        scheduler.start_turn(level, target)
+        waiting = set()
+        for entities, positions, future in self.pending:
+            waiting.update(entities)
+        flows = ([], [])
+        seeks = [([], []) for i in range(self.workers)]
+        # all flow requests share one field, so they go to the same worker
+        for entity in level.entities:
+            if not self.handles(entity):
+                continue
+            if entity in waiting:
+                entity.follow_path()
+                continue
+            if not scheduler.plan_turn(entity):
+                continue
+            request = entity.pathfind_request(level, target)
+            if request[0] == "flow":
+                group = flows
+            else:
+                group = min(seeks, key=lambda group: len(group[0]))
+            group[0].append(entity)
+            group[1].append(request)
+        for entities, requests in [flows] + seeks:
+            if len(requests) > 0:
+                task = (level.width, weights, blocked, target, requests)
+                positions = [request[1] for request in requests]
+                self.pending.append((entities, positions, self.executor.submit(pathfinding.plan_paths, task)))
+
+    def apply(self):
+        """Hands the results of finished tasks to their entities, without
+        waiting on the rest. Results for entities that have moved since
+        their request are dropped, as the next move would be from the wrong
+        tile.
+        """
+        waiting = []
+        for entities, positions, future in self.pending:
+            if not future.done():
+                waiting.append((entities, positions, future))
+                continue
+            for entity, position, result in zip(entities, positions, future.result()):
+                if (entity.x, entity.y) == position:
+                    entity.apply_pathfind_result(result)
+        self.pending = waiting
+
+    def discard(self):
+        """Drops results that haven't been applied, i.e. on level load."""
+        for entities, positions, future in self.pending:
+            future.cancel()
+        self.pending = []
+
 class Entity():
     """Base class for most entities, and should
     only be used for the purposes of inheritance.
@@ -91,6 +296,8 @@ class Entity():
         # projectile marker
         self.enemy = False
         # enemy marker
+        self.cheappathfind = False
+        # call_pathfind() takes next to no time, so PathfindScheduler only holds it back while asleep
         self.pickup = False
         # item entity that can be picked up (unimplemented)
         self.direction = 6
@@ -98,6 +305,12 @@ class Entity():
         self.sprite = None
         # overridden by specific entities
         self.next_move = (self.x, self.y)
+        self.path = None
+        # full path computed by seek_pathfind
+        self.pathage = 0
+        # turns since self.path was last planned from scratch
+        self.pathblocked = frozenset()
+        # blocked tiles the searches behind self.path ran into, see plan_step()
         self.health = -1
         # default value
         self.list_priority = False
@@ -109,21 +322,46 @@ class Entity():
         """Overridden by entities, used for animation."""
         return [self]
 
-    def update(self, layout, player, assets, entlist):
+    def update(self, layout, player, assets, entityindex):
         """Overridden by entities."""
         return [self]
     
-    def process_projectile_collisions(self, layout, entlist):
+    def process_projectile_collisions(self, layout, entityindex):
         """Checks if a projectile has hit the entity."""
-        for entity in entlist:
-            if (entity.x, entity.y) == (self.x, self.y) and entity.projectile:
-                self.health -= entity.damage
-                entity.collided = True
+        for entity in entityindex.projectiles_at((self.x, self.y)):
+            self.health -= entity.damage
+            entity.collided = True
 
 
     def call_pathfind(self, level, target, entities):
         """Overridden by entities, if they use pathfinding."""
         ...
+
+    def pathfind_request(self, level, target):
+        """Overridden by entities whose pathfinding can be run by a
+        PathfindPool. Returns the request as plain data, either
+        ("flow", position) to step down a flow field towards the target or
+        ("seek", position, path, pathage, pathblocked) to do what
+        seek_pathfind() does.
+        """
+        return None
+
+    def apply_pathfind_result(self, result):
+        """Takes a (next_move, path, pathage, pathblocked) result from a
+        PathfindPool.
+        """
+        self.next_move, self.path, self.pathage, self.pathblocked = result
+
+    def follow_path(self):
+        """Used instead of call_pathfind on turns where the entity doesn't
+        plan. Keeps walking along self.path if the entity is still on it,
+        otherwise next_move is left as it was.
+        """
+        if self.path is None or (self.x, self.y) not in self.path:
+            return
+        index = self.path.index((self.x, self.y))
+        if index + 1 < len(self.path):
+            self.next_move = self.path[index + 1]
     
     def move(self):
         """Moves an entity to their next tile, or turns them towards it.
@@ -178,32 +416,12 @@ class Entity():
             return True
         return False
 
-    def has_los(self, layout, target):
-        """Samples some points between the target and entitiy and checks if any 
-        of the tiles in the way are not transparent. As a result, it's not 100% reliable.
-        Additionally very slow, due to the sampling, but it was previously used for 
-        the simple pathfinding.
+    def has_los(self, level, target):
+        """Checks if there are no opaque tiles on the straight line between
+        the entity and the target. Answers are cached by level.visibility
+        until the transparency map changes.
         """
-        dx = self.x - target.x
-        dy = self.y - target.y
-        if dx == 0:
-            for i in range(abs(dy)):
-                if not layout[target.y + i][target.x].transparent:
-                    return False
-            return True
-        accuracy = 400
-        dy = self.y - target.y
-        m = dy/dx
-        c = self.y - m * self.x
-        for i in range(0, abs(dx * accuracy)):
-            if dx > 0:
-                currentx = target.x + i/accuracy
-            else:
-                currentx = target.x - i/accuracy
-            currenty = currentx * m + c
-            if not layout[round(currenty)][round(currentx)].transparent:
-                return False
-        return True
+        return level.visibility.has_los((self.x, self.y), (target.x, target.y))
 
     def simple_pathfind(self, level, target, entities):
         """Sets next_move to one tile closer to a given target if there is no obstruction."""
@@ -277,101 +495,28 @@ class Entity():
         
     
     def seek_pathfind(self, level, target, entities):
-        """A* Pathfinding implementation."""
-        grid = level.solidmap.copy()
-        for entity in entities:
-            if not entity.walkable and entity != self:
-                grid[entity.y][entity.x] = 0
-
-
-        openlist = [(self.x, self.y, 0, (self.x, self.y))]
-        closedlist = []
-
-        found = False
-        while len(openlist) > 0 and not found:
-
-            lowestindex = 0
-            for i in range(len(openlist)):
-                if openlist[i][2] < openlist[lowestindex][2]:
-                    lowestindex = i
-            current = openlist.pop(lowestindex)
-            closedlist.append(current)
-
-            if (current[0], current[1]) == target:
-                found = True
-
-            else:
-                if current[0] - 1 >= 0 and current[1] in range(len(grid)):
-                    if astarlistcheck((current[0] - 1, current[1]), closedlist) == None:
-                        weight = grid[current[1]][current[0] - 1]
-                        if weight > 0:
-                            h = abs(current[0] - 1 - target[0]) + abs(current[1] - target[1])
-                            g = current[2] + weight
-                            s = h + g
-                            check = astarlistcheck((current[0] - 1, current[1]), openlist)
-                            if check == None:
-                                openlist.append((current[0] - 1, current[1], s, (current[0], current[1])))
-                            elif check > s:
-                                openlist = astarremove((current[0] - 1, current[1], check), openlist)
-                                openlist.append((current[0] - 1, current[1], s, (current[0], current[1])))
-
-                if current[0] + 1 < len(grid[0]) and current[1] in range(len(grid)):
-                    if astarlistcheck((current[0] + 1, current[1]), closedlist) == None:
-                        weight = grid[current[1]][current[0] + 1]
-                        if weight > 0:
-                            h = abs(current[0] + 1 - target[0]) + abs(current[1] - target[1])
-                            g = current[2] + weight
-                            s = h + g
-                            check = astarlistcheck((current[0] + 1, current[1]), openlist)
-                            if check == None:
-                                openlist.append((current[0] + 1, current[1], s, (current[0], current[1])))
-                            elif check > s:
-                                openlist = astarremove((current[0] + 1, current[1], check), openlist)
-                                openlist.append((current[0] + 1, current[1], s, (current[0], current[1])))
-
-                if current[1] - 1 >= 0 and current[0] in range(len(grid[0])):
-                    if astarlistcheck((current[0], current[1] - 1), closedlist) == None:
-                        weight = grid[current[1] - 1][current[0]]
-                        if weight > 0:
-                            h = abs(current[0] - target[0]) + abs(current[1] - 1 - target[1])
-                            g = current[2] + weight
-                            s = h + g
-                            check = astarlistcheck((current[0], current[1] - 1), openlist)
-                            if check == None:
-                                openlist.append((current[0], current[1] - 1, s, (current[0], current[1])))
-                            elif check > s:
-                                openlist = astarremove((current[0], current[1] - 1, check), openlist)
-                                openlist.append((current[0], current[1] - 1, s, (current[0], current[1])))
-
-                if current[1] + 1 < len(grid) and current[0] in range(len(grid[0])):
-                    if astarlistcheck((current[0], current[1] + 1), closedlist) == None:
-                        weight = grid[current[1] + 1][current[0]]
-                        if weight > 0:
-                            h = abs(current[0] - target[0]) + abs(current[1] + 1 - target[1])
-                            g = current[2] + weight
-                            s = g + h
-                            check = astarlistcheck((current[0], current[1] + 1), openlist)
-                            if check == None:
-                                openlist.append((current[0], current[1] + 1, s, (current[0], current[1])))
-                            elif check > s:
-                                openlist = astarremove((current[0] + 1, current[1] + 1, check), openlist)
-                                openlist.append((current[0] + 1, current[1] + 1, s, (current[0], current[1])))
-
-        if found:
-            supposed_path = []
-            traversing_back = closedlist.pop(-1)
-            supposed_path.append(traversing_back)
-            while True:
-                if traversing_back[3] == (self.x, self.y):
-                    self.next_move = (traversing_back[0], traversing_back[1])
-                    break
-                else:
-                    while True:
-                        newnode = closedlist.pop(-1)
-                        if traversing_back[3] == (newnode[0], newnode[1]):
-                            traversing_back = newnode
-                            supposed_path.append(traversing_back)
-                            break
+        """A* Pathfinding implementation. Keeps the whole path to the target
+        in self.path and sets next_move to its first step. On later turns
+        the kept path is repaired rather than replaced, if the target only
+        moved a little or something got in the way. If the target can't be
+        reached, the entity stays where it is.
+        """
+        blocked = level.occupied
+        # the entity's own tile is the start of the path, so it is never checked
+        search = level.pathsearch.get_search()
+        self.next_move, self.path, self.pathage, self.pathblocked = pathfinding.plan_step(
+            level.solidmap, self.path, self.pathage, self.pathblocked, (self.x, self.y), tuple(target), blocked, search)
+
+    def flow_pathfind(self, level, target, entities):
+        """Sets next_move by stepping down the level's shared flow field.
+        Falls back to seek_pathfind() if there is no field for this target.
+        """
+        field = level.get_flow_field(target)
+        if field is None:
+            self.seek_pathfind(level, target, entities)
+            return
+        self.path = None
+        self.next_move = field.next_step((self.x, self.y))
 
     def call_pathfind(self, level, target, entities):
         pass
@@ -417,12 +562,17 @@ class Soldier(Entity):
         self.damagedsprite.blit(sprites.redtint, (0,0), special_flags = pg.BLEND_RGBA_MULT)
         # turn red briefly when damaged
         self.enemy = True
+        self.cheappathfind = True
+        # the flow field is built once per turn for every Soldier
         self.actiontick = 0
         self.damagetick = 0
         self.walkable = False
 
     def call_pathfind(self, level, target, entities):
-        self.seek_pathfind(level, target, entities)
+        self.flow_pathfind(level, target, entities)
+
+    def pathfind_request(self, level, target):
+        return ("flow", (self.x, self.y))
 
     def frame_update(self):
         # keep track of how long ago since it's been hit
@@ -430,7 +580,7 @@ class Soldier(Entity):
             self.damagetick -= 1
         return [self]
 
-    def update(self, layout, player, assets, entlist):
+    def update(self, layout, player, assets, entityindex):
 
         if self.actiontick == 1:
             self.actiontick = 0
@@ -443,7 +593,7 @@ class Soldier(Entity):
         if player.attacked and player.facing_tile == [self.x, self.y]:
             self.health -= player.dmg
             self.damagetick = 10
-        self.process_projectile_collisions(layout, entlist)
+        self.process_projectile_collisions(layout, entityindex)
         if self.health <= 0:
             return []
 
@@ -471,6 +621,7 @@ class Grunt(Entity):
         self.damagedsprite = self.sprite.copy()
         self.damagedsprite.blit(sprites.redtint, (0,0), special_flags = pg.BLEND_RGBA_MULT)
         self.enemy = True
+        self.cheappathfind = True
         self.actiontick = 0
         self.damagetick = 0
         self.walkable = False
@@ -484,7 +635,7 @@ class Grunt(Entity):
             self.damagetick -= 1
         return [self]
 
-    def update(self, layout, player, assets, entlist):
+    def update(self, layout, player, assets, entityindex):
         if self.actiontick == 1:
             self.actiontick = 0
     
@@ -502,7 +653,7 @@ class Grunt(Entity):
         if player.attacked and player.facing_tile == [self.x, self.y]:
             self.health -= player.dmg
             self.damagetick = 10
-        self.process_projectile_collisions(layout, entlist)
+        self.process_projectile_collisions(layout, entityindex)
         if self.health <= 0:
             return []
 
@@ -567,20 +718,19 @@ class Bomb(Entity):
                 self.light = 255
         return [self]
 
-    def update(self, layout, player, assets, entities):
+    def update(self, layout, player, assets, entityindex):
         self.fuse -= 1
         if self.fuse == 0:
-            explosion = self.explode(layout, player, entities)
+            explosion = self.explode(layout, player, entityindex)
             return explosion
         return [self]
     
-    def explode(self, layout, player, entities):
+    def explode(self, layout, player, entityindex):
+        for entity in entityindex.in_rect(self.x - 1, self.y - 1, 3, 3):
+            entity.health -= self.explosive_damage
         explosions = []
         for i in [-1, 0, 1]:
             for j in [-1, 0, 1]:
-                for entity in entities:
-                    if entity.x == self.x + j and entity.y == self.y + i:
-                        entity.health -= self.explosive_damage
                 explosions.append(Explosion((self.x + j, self.y + i)))
         return explosions
 
@@ -636,7 +786,7 @@ class Fireball(Entity):
             
                 
 
-    def update(self, layout, player, assets, entlist):
+    def update(self, layout, player, assets, entityindex):
         if self.just_spawned:
             self.just_spawned = False
             self.next_move = (self.x, self.y)
@@ -1,15 +1,15 @@
 """Main script. Run to play game."""
 import pygame as pg
-import menu
-import leveldata
-import blocks
-import entities
+import numpy as np
 import shader
+if __name__ == "__main__":
+    # these load sprites and open a window when imported. Worker processes
+    # started with the spawn method import this script again as __mp_main__,
+    # so they only get the modules above
+    import menu
+    import leveldata
+    import entities
 
-pg.mixer.pre_init(44100, -16, 4, 512)
-pg.init()
-pg.font.init()
-pg.key.set_repeat(200, 100)
 clock = pg.time.Clock()
 INFO = """
 GAME:
@@ -29,48 +29,36 @@ MENU:
 WS - Selection
 SPACE - Confirm
 """
-print(INFO)
 
 class Globals():
     """Class to contain various constants, assets and objects needed by many classes.
     The whole class can be passed to modules so that they can use rendering constants and
-    render on the main game screen.
+    render on the main game screen. The screen, fonts and textures are added by setup().
     """
-    screen = pg.display.set_mode((600, 600))
     ppb = 64
-    entities.sprites.resize(ppb)
     tilesx = 21
     tilesy = 11
     resolutionx = ppb * tilesx
     resolutiony = ppb * tilesy
 
-    textfont_40p = pg.font.Font("-font.ttf", 40)
-    textfont_30p = pg.font.Font("-font.ttf", 30)
-    textfont_20p = pg.font.Font("-font.ttf", 20)
-
-    darktexture = pg.Surface((ppb, ppb))
-    darktexture.fill((0, 0, 0))
-    darktexturesmall = pg.transform.scale(darktexture, (21, 21))
-    darktexturelong = pg.transform.scale(darktexture, (22, 21))
-    darktexturetall = pg.transform.scale(darktexture, (21, 22))
-    darktexturebig = pg.transform.scale(darktexture, (22, 22))
-    darktexturedict = {}
-    darktexturesmalldict = {}
-    darktexturelongdict = {}
-    darktexturetalldict = {}
-    darktexturebigdict = {}
-
-    for i in range(256):
-        darktexture.set_alpha(i)
-        darktexturesmall.set_alpha(i)
-        darktexturelong.set_alpha(i)
-        darktexturetall.set_alpha(i)
-        darktexturebig.set_alpha(i)
-        darktexturedict[i] = darktexture.copy()
-        darktexturesmalldict[i] = darktexturesmall.copy()
-        darktexturelongdict[i] = darktexturelong.copy()
-        darktexturetalldict[i] = darktexturetall.copy()
-        darktexturebigdict[i] = darktexturebig.copy()
+def setup():
+    """Starts pygame, prints the controls and loads the assets kept in
+    Globals. Call once before creating a Game.
+    """
+    pg.mixer.pre_init(44100, -16, 4, 512)
+    pg.init()
+    pg.font.init()
+    pg.key.set_repeat(200, 100)
+    print(INFO)
+    Globals.screen = pg.display.set_mode((600, 600))
+    entities.sprites.resize(Globals.ppb)
+
+    Globals.textfont_40p = pg.font.Font("-font.ttf", 40)
+    Globals.textfont_30p = pg.font.Font("-font.ttf", 30)
+    Globals.textfont_20p = pg.font.Font("-font.ttf", 20)
+
+    Globals.darktexture = pg.Surface((Globals.ppb, Globals.ppb))
+    Globals.darktexture.fill((0, 0, 0))
 
 class Game():
     """Main class required for the game. Initialize to start the game.
@@ -79,13 +67,18 @@ class Game():
         """Instantiate game before starting."""
         self.tick = 1
         self.shader = shader.Shader()
+        self.pathpool = entities.PathfindPool()
+        # set workers above 1 to pathfind in other processes, a turn behind
+        self.jumppoints = False
+        # set to pathfind with jump point search on small levels, see pathbenchmark.py
         self.maxtick = 60
         self.menu = menu.Menu(Globals)
         self.state = "start"
-        self.defaulttexture = blocks.Void(Globals.ppb)
         self.running = True
         self.to_reload = None
         self.action_timer = 0
+        self.lastframe = None
+        # what render() drew last, see dirty_rects()
         pg.display.set_icon(pg.image.load("-icon.png"))
         pg.display.set_caption("Dungeon Crawler")
 
@@ -103,7 +96,8 @@ class Game():
                 # the main menu process terminates when the player has selected a level
                 # and returns the name of the level chosen.
                 level_selection = self.menu.process(self)
-                self.level = leveldata.LevelData(level_selection, Globals)
+                self.level = leveldata.LevelData(level_selection, Globals, self.jumppoints)
+                self.pathpool.discard()
                 self.shader.set_dimensions(self.level)
                 self.player = self.level.player
                 self.state = "gameplay"
@@ -142,8 +136,8 @@ class Game():
                             else:
                                 self.player.down(self.level)
                         elif event.key == pg.K_e and not self.player.inventory.open:
-                            for entity in self.level.entities:
-                                if entity.interactable and (entity.x, entity.y) == tuple(self.player.facing_tile):
+                            for entity in self.level.entityindex.at(self.player.facing_tile):
+                                if entity.interactable:
                                     entity.interacted = True
                             self.player.interacted = True
                             self.player.turn = False
@@ -198,9 +192,16 @@ class Game():
                 # Processing
                 self.frame_update()
                 if not self.player.turn:
+                    self.pathpool.apply()
+                    self.level.update_flow_field((self.player.x, self.player.y))
+                    self.level.scheduler.start_turn(self.level, (self.player.x, self.player.y))
                     for entity in self.level.entities:
-                        entity.call_pathfind(self.level, (self.player.x, self.player.y), self.level.entities)
+                        if self.pathpool.handles(entity):
+                            continue
+                        if self.level.scheduler.plan_turn(entity):
+                            entity.call_pathfind(self.level, (self.player.x, self.player.y), self.level.entities)
                     self.update()
+                    self.pathpool.submit(self.level, (self.player.x, self.player.y), self.level.scheduler)
                 self.render()
 
             elif self.state == "win":
@@ -272,54 +273,135 @@ class Game():
 
     def render(self):
         """Renders all assets to the screen based on their current sprites
-        and position attributes.
+        and position attributes. Only the parts of the screen that changed
+        since the last frame are drawn again and sent to the display, see
+        dirty_rects().
         """
-        # setting up variables for more comprehensible pg method calls
-        Globals.screen.fill((0, 0, 0))
         midpointx = int(Globals.tilesx / 2)
         midpointy = int(Globals.tilesy / 2)
         offsetx = self.player.x - midpointx
         offsety = self.player.y - midpointy
-        dim = (Globals.ppb, Globals.ppb)
         ppb = Globals.ppb
-        sp = self.player.arrowsprites # sprites
-        po = int(ppb * 0.05) # player offset
-        facing_interactable = False
 
         self.sort_entities()
-        render_array = []
-        for i in range(Globals.tilesy):
-            render_array.append([])
-            for j in range(Globals.tilesx):
-                render_array[i].append(self.defaulttexture)
-                if i + offsety > -1 and j + offsetx > -1 and i + offsety < self.level.height and j + offsetx < self.level.width:
-                    render_array[i][j] = self.level.rows[i + offsety][j + offsetx]
-                Globals.screen.blit(render_array[i][j].sprite, (ppb*j, ppb*i))
+        frame = self.frame_state(offsetx, offsety)
+        world, ui = self.dirty_rects(frame)
+        self.lastframe = frame
+        inventory = self.player.inventory
+        if world is not None:
+            Globals.screen.set_clip(world)
+            Globals.screen.fill((0, 0, 0))
+            self.level.tilechunks.draw(Globals.screen, offsetx, offsety, Globals.tilesx, Globals.tilesy)
+            for location, sprite in frame["sprites"]:
+                Globals.screen.blit(sprite, location)
+            self.render_shading(frame["lights"], ppb)
+            if inventory.open or inventory.opening:
+                inventory.render(Globals.screen)
+        if ui is not None:
+            Globals.screen.set_clip(ui)
+            if inventory.open or inventory.opening:
+                inventory.render(Globals.screen)
+            self.player.ui.render(self.player, Globals, inventory)
+        Globals.screen.set_clip(None)
+        pg.display.update([rect for rect in (world, ui) if rect is not None])
+
+    def frame_state(self, offsetx, offsety) -> "Dictionary":
+        """Collects everything render() draws, so that it can be compared
+        with the last frame. Sprites are kept as (location, surface) pairs
+        in the order they are drawn.
+        """
+        ppb = Globals.ppb
+        po = int(ppb * 0.05) # player offset
+        midpointx = int(Globals.tilesx / 2)
+        midpointy = int(Globals.tilesy / 2)
+        facing_interactable = False
+        sprites = []
         for entity in self.level.entities:
             if entity.x - offsetx in range(Globals.tilesx) and entity.y - offsety in range(Globals.tilesy):
-                Globals.screen.blit(entity.get_sprite(), (ppb*(entity.x - offsetx), (entity.y - offsety)*ppb))
+                sprites.append(((ppb*(entity.x - offsetx), (entity.y - offsety)*ppb), entity.get_sprite()))
                 if entity.interactable and (entity.x, entity.y) == tuple(self.player.facing_tile):
                     facing_interactable = True
-        Globals.screen.blit(self.player.sprite, (midpointx*ppb, midpointy*ppb - po))
-        self.render_arrows(facing_interactable)
-        self.render_shading(offsetx, offsety, dim, ppb)
-        if self.player.inventory.open or self.player.inventory.opening:
-            self.player.inventory.render(Globals.screen)
-        self.player.ui.render(self.player, Globals, self.player.inventory)
-        
-        pg.display.flip()
+        sprites.append(((midpointx*ppb, midpointy*ppb - po), self.player.sprite))
+        spritecode, location = self.arrow_state(facing_interactable)
+        sprites.append((location, self.player.arrowsprites[spritecode]))
+
+        inventory = self.player.inventory
+        inventorykey = None
+        inventoryrect = None
+        if inventory.open or inventory.opening:
+            inventorykey = (inventory.current_position, inventory.pointer, inventory.capacity,
+                            tuple(item.render_sprite for item in inventory.items))
+            inventoryrect = pg.Rect(inventory.renderposx, inventory.current_position, inventory.width, inventory.height)
+        slots = (inventory.upindex, inventory.leftindex, inventory.downindex, inventory.rightindex)
+        uikey = (self.player.health, self.player.max_health,
+                 tuple(None if slot is None else inventory.items[slot].render_sprite for slot in slots))
+        # the keys hold the item sprites themselves rather than their ids,
+        # which can be reused once a sprite replaced on use is freed
+        return {
+            "screen": Globals.screen,
+            "level": self.level,
+            "offset": (offsetx, offsety),
+            "sprites": sprites,
+            "lights": self.shadow_window(offsetx, offsety),
+            "inventory": inventorykey,
+            "inventoryrect": inventoryrect,
+            "ui": uikey
+        }
+
+    def dirty_rects(self, frame) -> "Rect, Rect":
+        """Compares a frame_state() with the last one and returns the
+        regions of the world view and of the UI bar that need drawing
+        again, either of which is None if nothing in it changed. Sprites
+        are compared tile by tile in the order they are drawn, so a tile is
+        redrawn when the sprites on it swap places too. Moving the view,
+        loading a level or resizing the screen redraws everything.
+        """
+        worldarea = pg.Rect(0, 0, Globals.resolutionx, Globals.resolutiony)
+        uiarea = pg.Rect(0, Globals.resolutiony, Globals.resolutionx, self.player.ui.height)
+        last = self.lastframe
+        if (last is None or last["screen"] is not frame["screen"] or last["level"] is not frame["level"]
+                or last["offset"] != frame["offset"] or last["lights"].shape != frame["lights"].shape):
+            return worldarea, uiarea
+        rects = []
+        old = {}
+        new = {}
+        for sprites, drawn in ((old, last["sprites"]), (new, frame["sprites"])):
+            for location, sprite in drawn:
+                sprites.setdefault(location, []).append(sprite)
+        for location in old.keys() | new.keys():
+            if old.get(location) != new.get(location):
+                # the sprites drawn there, or the order they are stacked in, changed
+                for sprite in old.get(location, []) + new.get(location, []):
+                    rects.append(sprite.get_rect(topleft=location))
+        changed = np.argwhere(last["lights"] != frame["lights"])
+        if len(changed) > 0:
+            # one cell of margin, since smoothscale blends neighbouring cells
+            cellwidth = Globals.tilesx * Globals.ppb / frame["lights"].shape[1]
+            cellheight = Globals.tilesy * Globals.ppb / frame["lights"].shape[0]
+            top, left = changed.min(axis=0) - 1
+            bottom, right = changed.max(axis=0) + 2
+            rects.append(pg.Rect(int(left * cellwidth), int(top * cellheight),
+                                 int((right - left) * cellwidth) + 1, int((bottom - top) * cellheight) + 1))
+        if last["inventory"] != frame["inventory"]:
+            rects += [rect for rect in (last["inventoryrect"], frame["inventoryrect"]) if rect is not None]
+        world = [rect.clip(worldarea) for rect in rects if rect.colliderect(worldarea)]
+        ui = [rect.clip(uiarea) for rect in rects if rect.colliderect(uiarea)]
+        if last["ui"] != frame["ui"]:
+            ui = [uiarea]
+        world = world[0].unionall(world[1:]) if len(world) > 0 else None
+        ui = ui[0].unionall(ui[1:]) if len(ui) > 0 else None
+        return world, ui
 
-    def render_arrows(self, facing_interactable):
-        """Subroutine for the render() method. Overlays arrows dependent on
-        where the player is facing and on whether or not they are facing
-        an interactable object (boolean to be passed).
+    def arrow_state(self, facing_interactable) -> "Sprite code, location":
+        """Subroutine for the render() method. Picks the arrow sprite and
+        location dependent on where the player is facing and on whether or
+        not they are facing an interactable object (boolean to be passed).
         """
         cycle = round(4 * self.tick / self.maxtick)
         if cycle == 4:
             cycle = 2
         elif cycle == 0:
             cycle = 2
-        sp = self.player.arrowsprites
         ppb = Globals.ppb
         midpointx = int(Globals.tilesx / 2)
         midpointy = int(Globals.tilesy / 2)
@@ -335,47 +417,37 @@ class Game():
         if facing_interactable:
             spritecode = "c"
         spritecode += str(cycle)
-        Globals.screen.blit(sp[spritecode], location)
-
-    def render_shading(self, offsetx, offsety, dim, ppb):
-        """Subroutine for the render() method. Gets a shadow map from
-        shader.py and draws it on the screen. Upscaling is currently not
-        working as intended, but can be tested by setting self.shader.upscale
-        to True. If upscaling is enabled, the routine will enlarge the shadow map
-        and use bilinear interpolation to smoothen the lighting."""
-        if self.shader.upscale == True:
-            offsetx *= 3
-            offsety *= 3
-            resolution = 3
-            ppb = int(Globals.ppb /3)
-        else:
-            resolution = 1
+        return spritecode, location
+
+    def shadow_window(self, offsetx, offsety) -> "2D Array":
+        """Gets the shadow map of the visible part of the level from shader.py."""
         lightlist = []
         lightlist.append([self.player.light, self.player.x, self.player.y])
         for entity in self.level.entities:
             if entity.luminescent:
                 lightlist.append([entity.light, entity.x, entity.y])
-        array = self.shader.generate_shadow_array(lightlist)
-        render_array = []
-        for i in range(Globals.tilesy * resolution):
-            render_array.append([])
-            for j in range(Globals.tilesx * resolution):
-                render_array[i].append(0)
-                if i + offsety > -1 and j + offsetx > -1 and i + offsety < len(array) and j + offsetx < len(array[0]):
-                    render_array[i][j] = array[i + offsety][j + offsetx]
-                if render_array[i][j] != None and render_array[i][j] < 255:
-                    if self.shader.upscale:
-                        if i % 3 == 0 == j % 3:
-                            Globals.screen.blit(Globals.darktexturebigdict[255 - render_array[i][j]], (ppb*j, ppb*i))
-                        elif i % 3 == 0:
-                            Globals.screen.blit(Globals.darktexturetalldict[255 - render_array[i][j]], (ppb*j, ppb*i))
-                        elif j % 3 == 0:
-                            Globals.screen.blit(Globals.darktexturelongdict[255 - render_array[i][j]], (ppb*j, ppb*i))
-                        else:
-                            Globals.screen.blit(Globals.darktexturesmalldict[255 - render_array[i][j]], (ppb*j, ppb*i))
-                    else:
-                        Globals.screen.blit(Globals.darktexturedict[255 - render_array[i][j]], (round(ppb*j), round(ppb*i)))
-        # self.debug(array)
+        return self.shader.generate_shadow_array(lightlist, (offsetx, offsety, Globals.tilesx, Globals.tilesy))
+
+    def render_shading(self, window, ppb):
+        """Subroutine for the render() method. Draws a shadow_window() on the
+        screen. The window is written into a small alpha surface, one pixel
+        per shadow map cell, which is then scaled up and blitted over the
+        screen in one go. Setting self.shader.smooth to True blends the
+        light between tiles, and setting self.shader.upscale to True
+        interpolates the shadow map itself before it is drawn."""
+        lightmap = pg.Surface((window.shape[1], window.shape[0]), pg.SRCALPHA)
+        lightmap.fill((0, 0, 0, 255))
+        alpha = pg.surfarray.pixels_alpha(lightmap)
+        alpha[:] = 255 - np.clip(window, 0, 255).T
+        del alpha
+        # the surface stays locked while the pixel array exists
+        size = (Globals.tilesx * ppb, Globals.tilesy * ppb)
+        if self.shader.smooth:
+            lightmap = pg.transform.smoothscale(lightmap, size)
+        else:
+            lightmap = pg.transform.scale(lightmap, size)
+        Globals.screen.blit(lightmap, (0, 0))
+        # self.debug(window)
 
     def debug(self, array):
         """Not part of the game, but could be converted to a method to render a minimap.
@@ -408,7 +480,9 @@ class Game():
         # ensure projectiles behave as intended with collision order
         temp_entities = []
         for i in range(len(self.level.entities)):
-            temp_entities = self.level.entities[i].update(self.level.rows, self.player, Globals, self.level.entities) + temp_entities
+            temp_entities = self.level.entities[i].update(self.level.rows, self.player, Globals, self.level.entityindex) + temp_entities
+            self.level.entityindex.move(self.level.entities[i])
+            # later entities see where this one ended up, as with the plain list
         for entity in temp_entities:
             if entity.__class__.__name__ == "Teleporter":
                 if entity.interacted is True:
@@ -417,6 +491,7 @@ class Game():
                         return
                     self.to_reload = entity.destination
         self.level.entities = temp_entities
+        self.level.refresh_entities()
         self.player.update(self)
     
     def frame_update(self):
@@ -430,6 +505,7 @@ class Game():
         for i in range(len(self.level.entities)):
             temp_entities = self.level.entities[i].frame_update() + temp_entities
         self.level.entities = temp_entities
+        self.level.refresh_entities()
         self.player.frame_update(self)
         self.player.inventory.frame_update()
     
@@ -437,7 +513,8 @@ class Game():
         """Loads a game.to_reload but retains the player
         object, only changing their position attributes.
         """
-        self.level = leveldata.LevelData(self.to_reload, Globals)
+        self.level = leveldata.LevelData(self.to_reload, Globals, self.jumppoints)
+        self.pathpool.discard()
         xdiff = self.player.x - self.level.player.x
         ydiff = self.player.y - self.level.player.y
         self.player.facing_tile = [self.player.facing_tile[0] - xdiff, self.player.facing_tile[1] - ydiff]
@@ -465,11 +542,14 @@ class Game():
         pg.display.flip()
 
 
-game = Game()
-try:
-    game.process()
-except SystemExit:
-    pg.quit()
-    input()
+if __name__ == "__main__":
+    # guarded so that worker processes importing this script don't start a game
+    setup()
+    game = Game()
+    try:
+        game.process()
+    except SystemExit:
+        pg.quit()
+        input()
 
 
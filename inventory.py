@@ -31,6 +31,9 @@ class Inventory():
         self.downindex = None
         self.rightindex = None
         self.leftindex = None
+        self.panel = None
+        self.panelkey = None
+        # what the cached panel shows, see get_panel()
     
     def generate_sprite(self, assets):
         """Routine used to set up the size of the menu,
@@ -69,6 +72,9 @@ class Inventory():
 
         self.boxspritedim = (int(self.width * 0.2), int(self.width * 0.2))
         self.boxsprite = pg.transform.scale(self.boxsprite, self.boxspritedim).convert_alpha()
+        self.emptybox = pg.Surface(self.boxspritedim)
+        self.emptybox.fill((20, 20, 20, 230))
+        # drawn in the item wheel when there are no items
         for key in spritedict:
             spritedict[key] = pg.transform.scale(spritedict[key], self.boxspritedim).convert_alpha()
         
@@ -86,6 +92,7 @@ class Inventory():
             arrow = pg.transform.rotate(arrow, 90)
             arrowbox.blit(self.boxsprite, (0, 0))
             self.slotswitharrows[direction] = arrowbox.copy()
+        self.panel = None
 
 
 
@@ -159,9 +166,7 @@ class Inventory():
             if wheeldata != None:
                 wheelsurface.blit(self.items[wheeldata[i]].render_sprite, (int(1.25 * self.boxspritedim[0]) * i, 0))
             else:
-                box = pg.Surface(self.boxspritedim)
-                box.fill((20, 20, 20, 230))
-                wheelsurface.blit(box,(int(1.25 * self.boxspritedim[0]) * i, 0))
+                wheelsurface.blit(self.emptybox,(int(1.25 * self.boxspritedim[0]) * i, 0))
                 wheelsurface.blit(self.boxsprite,(int(1.25 * self.boxspritedim[0]) * i, 0))
         sizedsurface.blit(wheelsurface, (0, 0), ((self.boxspritedim[0] * 6 - self.usable_dimensions[0])/2, 0, self.usable_dimensions[0], self.boxspritedim[0]))
         return sizedsurface
@@ -219,13 +224,22 @@ class Inventory():
                 self.open = False
                 self.closing = False
 
+    def get_panel(self) -> "Inventory Surface":
+        """Returns the inventory sprite with the item wheel drawn on it.
+        It is only drawn again when the pointer, the items or their
+        durability change, which replaces their render_sprite.
+        """
+        key = (self.pointer, self.capacity, tuple(item.render_sprite for item in self.items))
+        if self.panel is None or key != self.panelkey:
+            self.panel = self.sprite.copy()
+            self.panel.blit(self.make_wheel(), (self.contour_width, int(self.height * 0.4)))
+            self.panelkey = key
+        return self.panel
+
     def render(self, surface):
         """Renders the inventory to the screen surface given."""
-        invsprite = self.sprite.copy()
-        itemwheel = self.make_wheel()
-        invsprite.blit(itemwheel, (self.contour_width, int(self.height * 0.4)))
         topleft = (self.renderposx, self.current_position)
-        surface.blit(invsprite, topleft)
+        surface.blit(self.get_panel(), topleft)
 
     
     def add(self, item):
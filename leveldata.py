@@ -2,12 +2,73 @@ import pygame as pg
 import blocks
 import entities
 import copy
+import pathfinding
+import visibility
 from player import Player
 from userinterface import UserInterface
 
+class TileChunks():
+    """The level's tiles pre-rendered onto square chunk surfaces of
+    chunksize tiles, so that drawing the background takes a few blits
+    instead of one per tile. Chunks are rendered from the tiles' own
+    sprites (grass decorations included) the first time they come into
+    view, and dropped again once they are more than a chunk away from it.
+    Tiles outside the level are drawn with the default sprite.
+    """
+    def __init__(self, rows, ppb, default, chunksize=16):
+        self.rows = rows
+        self.ppb = ppb
+        self.default = default
+        self.chunksize = chunksize
+        self.chunks = {}
+        # (chunk x, chunk y) -> surface
+
+    def get_chunk(self, chunkx, chunky) -> "Surface":
+        key = (chunkx, chunky)
+        if key not in self.chunks:
+            size = self.chunksize * self.ppb
+            chunk = pg.Surface((size, size))
+            for i in range(self.chunksize):
+                y = chunky * self.chunksize + i
+                for j in range(self.chunksize):
+                    x = chunkx * self.chunksize + j
+                    if 0 <= y < len(self.rows) and 0 <= x < len(self.rows[0]):
+                        chunk.blit(self.rows[y][x].sprite, (j * self.ppb, i * self.ppb))
+                    else:
+                        chunk.blit(self.default, (j * self.ppb, i * self.ppb))
+            self.chunks[key] = chunk
+        return self.chunks[key]
+
+    def draw(self, surface, offsetx, offsety, tilesx, tilesy):
+        """Draws the tilesx by tilesy tiles starting at (offsetx, offsety)
+        onto the top left of surface.
+        """
+        left = offsetx // self.chunksize
+        top = offsety // self.chunksize
+        right = (offsetx + tilesx - 1) // self.chunksize
+        bottom = (offsety + tilesy - 1) // self.chunksize
+        view = pg.Rect(0, 0, tilesx * self.ppb, tilesy * self.ppb)
+        clip = surface.get_clip()
+        surface.set_clip(view.clip(clip))
+        # chunks hang over the edge of the view, and mustn't cover the rest of the screen
+        for chunky in range(top, bottom + 1):
+            for chunkx in range(left, right + 1):
+                position = ((chunkx * self.chunksize - offsetx) * self.ppb, (chunky * self.chunksize - offsety) * self.ppb)
+                surface.blit(self.get_chunk(chunkx, chunky), position)
+        surface.set_clip(clip)
+        for chunkx, chunky in list(self.chunks):
+            if not (left - 1 <= chunkx <= right + 1 and top - 1 <= chunky <= bottom + 1):
+                del self.chunks[(chunkx, chunky)]
+
+    def invalidate_tile(self, x, y):
+        """Call after changing a tile's sprite so its chunk is rendered again."""
+        self.chunks.pop((x // self.chunksize, y // self.chunksize), None)
+
 class LevelData():
-    """Stores and processes one loaded level."""
-    def __init__(self, selection, assets):
+    """Stores and processes one loaded level. Set jumppoints to let
+    seeking entities use jump point search, see SearchPicker.
+    """
+    def __init__(self, selection, assets, jumppoints=False):
         size = assets.ppb
         compressiondict = {
             "g": blocks.Grass(size), # grass
@@ -28,6 +89,15 @@ class LevelData():
                 item_data = []
         self.name = selection
         self.entities = []
+        self.flowfield = None
+        # shared by every entity chasing the player, see get_flow_field()
+        self.flowtarget = None
+        self.entityindex = entities.EntityIndex()
+        # kept in step with self.entities by refresh_entities()
+        self.occupied = self.entityindex.occupied
+        # occupancy grid - (x, y) -> number of non-walkable entities on that tile
+        self.scheduler = entities.PathfindScheduler()
+        # picks which enemies pathfind each turn
         self.width = int(level_data[0])
         self.height = int(level_data[1])
         self.player = eval(level_data[2])
@@ -37,6 +107,7 @@ class LevelData():
         if entitylist[0] != "":
             for entitystring in entitylist:
                 self.entities.append(eval("entities." + entitystring))
+        self.refresh_entities()
         self.rows = []
         iteration = 0
         for i in range(self.height):
@@ -45,6 +116,7 @@ class LevelData():
                 self.rows[i].append(copy.copy(compressiondict[tilelist[iteration]]))
                 iteration += 1
         self.spritepass(assets.ppb)
+        self.tilechunks = TileChunks(self.rows, assets.ppb, blocks.Void(assets.ppb).sprite)
         self.player.inventory.generate_sprite(assets)
         self.player.add_inventory_items(item_data)
         ui = UserInterface(self.player, assets)
@@ -62,24 +134,56 @@ class LevelData():
                 else:
                     self.transparency_map[i].append(False)
                 self.solidmap[i].append(self.rows[i][j].weight)
+        self.visibility = visibility.VisibilityCache(self.transparency_map)
+        self.pathsearch = pathfinding.SearchPicker(self.solidmap, jumppoints)
+        # picks the search seek_pathfind() uses, see SearchPicker
 
     def spritepass(self, ppb):
-        """Iterates through every tile and calls their choose_sprite()
-        method, if they have one.
-        choose_sprite determines their texture based on surrounding
-        tiles.
+        """Gives every tile that has a set_sprite() method its texture,
+        based on surrounding tiles. The neighbour masks of the whole level
+        are worked out at once by blocks.neighbour_masks(), which matches
+        calling choose_sprite() on each tile.
         """
+        groupids = {}
+        groups = [[groupids.setdefault(tile.group, len(groupids)) for tile in row] for row in self.rows]
+        masks = blocks.neighbour_masks(groups).tolist()
         for i in range(0, len(self.rows)):
             for j in range(0, len(self.rows[0])):
                 try:
-                    self.rows[i][j].choose_sprite((j, i), self.rows, ppb)
-                except AttributeError:
-                    pass
-                try:
-                    self.rows[i][j].do_additional_generation((j, i), self.rows, ppb)
+                    self.rows[i][j].set_sprite(masks[i][j], (j, i), self.rows, ppb)
                 except AttributeError:
                     pass
 
+    def update_flow_field(self, target):
+        """Sets the target (normally the player) of the flow field that
+        seeking entities follow this turn. Should be called once per turn,
+        before entities pathfind. The field itself is only built when an
+        entity first asks for it, so turns where every enemy is asleep
+        don't pay for it.
+        """
+        self.flowtarget = tuple(target)
+        self.flowfield = None
+
+    def get_flow_field(self, target) -> "FlowField":
+        """Returns this turn's flow field, or None if it leads somewhere
+        other than target. Non-walkable entities block the way.
+        """
+        if self.flowtarget != tuple(target):
+            return None
+        if self.flowfield is None:
+            self.flowfield = pathfinding.FlowField(self.solidmap, self.flowtarget, self.occupied)
+        return self.flowfield
+
+    def refresh_entities(self):
+        """Brings the entity index and occupancy grid up to date with
+        self.entities. Should be called whenever the entity list is replaced.
+        """
+        self.entityindex.sync(self.entities)
+
+    def is_blocked(self, position) -> "Boolean":
+        """Checks if a non-walkable entity is standing on a tile."""
+        return tuple(position) in self.occupied
+
     def generate_base_lighting(self):
         """Pre-processed the lighting values due to ground tiles, since
         they will always be static. Saves a lot of resources in well-lit levels."""
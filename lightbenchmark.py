@@ -0,0 +1,196 @@
+"""Headless benchmark for the lighting in shader.py. Run on its own to time
+Shader.set_dimensions() and Shader.generate_shadow_array() on synthetic and
+real levels, and to check the results against the original recursive flood
+fill. No window is opened and no sprites are loaded.
+
+python lightbenchmark.py [--sizes 20 50 100] [--frames 60] [--workers 4] [--no-reference]
+"""
+import argparse
+import os
+import random
+import time
+import zlib
+import numpy as np
+import shader
+
+TILES = { # mirrors the compressiondict in leveldata.py
+    "g": (255, True, True), # grass - light, luminous, transparent
+    "v": (0, False, True), # void
+    "a": (0, False, True), # air
+    "w": (0, False, False), # wall
+    "h": (0, False, True), # hidden
+    "i": (0, False, True), # indoor
+    "p": (255, True, True) # pond
+}
+
+class BenchLevel():
+    """Stand-in for LevelData holding only what Shader needs.
+    Pass the level dimensions and a string of tile characters."""
+    def __init__(self, name, width, height, tiles):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.tiles = tiles
+        self.transparency_map = []
+        for i in range(height):
+            self.transparency_map.append([TILES[tile][2] for tile in tiles[i * width:(i + 1) * width]])
+
+    def generate_base_lighting(self):
+        """Same output as LevelData.generate_base_lighting()."""
+        baselighting = []
+        lights_to_preprocess = []
+        for i in range(self.height):
+            baselighting.append([])
+            for j in range(self.width):
+                light, luminous, transparent = TILES[self.tiles[i * self.width + j]]
+                if luminous:
+                    lights_to_preprocess.append([light, j, i])
+                baselighting[i].append(light)
+        return baselighting, lights_to_preprocess
+
+def convert_data(data):
+    """Same as LevelData.convert_data(), expands the run length encoded tiles."""
+    instructions = ""
+    current = ""
+    for character in data:
+        try:
+            int(character)
+            current += character
+        except ValueError:
+            instructions += int(current) * character
+            current = ""
+    return instructions
+
+def load_level(name):
+    """Reads a level from the levels folder without creating any of its objects."""
+    with open("levels/" + name, "r") as f:
+        level_data = f.read().split("\n")[0].split("|")
+    return BenchLevel(name, int(level_data[0]), int(level_data[1]), convert_data(level_data[3]))
+
+def random_level(width, height, seed=0):
+    """Generates a level with grassy clearings, caves, walls and ponds."""
+    rng = random.Random(seed)
+    tiles = "".join(rng.choices("giwp", weights=[35, 35, 25, 5], k=width * height))
+    return BenchLevel("random " + str(width) + "x" + str(height), width, height, tiles)
+
+def random_lights(level, count, intensity, seed=0):
+    """Places lights of one intensity on random transparent tiles."""
+    rng = random.Random(seed)
+    spots = [(j, i) for i in range(level.height) for j in range(level.width) if level.transparency_map[i][j]]
+    if len(spots) == 0:
+        return []
+    return [[intensity, x, y] for x, y in rng.choices(spots, k=count)]
+
+class ReferenceShader(shader.Shader):
+    """The original recursive flood fill, kept as a correctness reference."""
+    def set_dimensions(self, level):
+        self.arrayx = level.width
+        self.arrayy = level.height
+        self.transparency_map = level.transparency_map
+        self.baselighting, preprocesslights = level.generate_base_lighting()
+        for light in preprocesslights:
+            self.recurse(light, self.baselighting)
+
+    def recurse(self, light, array):
+        """Recurses a light vector3 into adjacent tiles if possible."""
+        if light[0] <= 0:
+            return
+        if array[light[2]][light[1]] > light[0]:
+            return
+        array[light[2]][light[1]] = light[0]
+        if not self.transparency_map[light[2]][light[1]]:
+            return
+        if light[0] - self.dropoff > 0:
+            if light[1] > 0:
+                self.recurse([light[0] - self.dropoff, light[1] - 1, light[2]], array)
+            if light[1] < self.arrayx - 1:
+                self.recurse([light[0] - self.dropoff, light[1] + 1, light[2]], array)
+            if light[2] > 0:
+                self.recurse([light[0] - self.dropoff, light[1], light[2] - 1], array)
+            if light[2] < self.arrayy - 1:
+                self.recurse([light[0] - self.dropoff, light[1], light[2] + 1], array)
+        if light[0] - self.diagonaldropoff > 0:
+            if light[1] > 0 and light[2] > 0:
+                self.recurse([light[0] - self.diagonaldropoff, light[1] - 1, light[2] - 1], array)
+            if light[1] < self.arrayx - 1 and light[2] < self.arrayy - 1:
+                self.recurse([light[0] - self.diagonaldropoff, light[1] + 1, light[2] + 1], array)
+            if light[1] > 0 and light[2] < self.arrayy - 1:
+                self.recurse([light[0] - self.diagonaldropoff, light[1] - 1, light[2] + 1], array)
+            if light[1] < self.arrayx - 1 and light[2] > 0:
+                self.recurse([light[0] - self.diagonaldropoff, light[1] + 1, light[2] - 1], array)
+
+    def generate_shadow_array(self, lightlist, view=None) -> "2D Array":
+        array = [x[:] for x in self.baselighting]
+        for light in lightlist:
+            self.recurse(light, array)
+        array = np.array(array, dtype=np.int32)
+        if view is not None:
+            array = self.get_window(array, *view)
+        return array
+
+def checksum(array):
+    """Short, stable fingerprint of a shadow array."""
+    return zlib.crc32(np.ascontiguousarray(array, dtype=np.int32).tobytes())
+
+def time_call(function, *args, repeat=1):
+    """Returns the result of the last call and the mean time per call in milliseconds."""
+    start = time.perf_counter()
+    for i in range(repeat):
+        result = function(*args)
+    return result, (time.perf_counter() - start) * 1000 / repeat
+
+def bench_level(level, lightcounts, intensities, frames, reference=True, workers=1):
+    """Times one level for every light count and intensity and prints a row for each."""
+    current = shader.Shader()
+    current.diskcache = False
+    current.workers = workers
+    unused, loadtime = time_call(current.set_dimensions, level)
+    if reference:
+        old = ReferenceShader()
+        unused, oldloadtime = time_call(old.set_dimensions, level)
+        print("%-22s load %9.2f ms   reference %9.2f ms" % (level.name, loadtime, oldloadtime))
+    else:
+        print("%-22s load %9.2f ms" % (level.name, loadtime))
+    rows = []
+    for count in lightcounts:
+        for intensity in intensities:
+            lights = random_lights(level, count, intensity)
+            view = (level.width // 2 - 10, level.height // 2 - 5, 21, 11)
+            current.lightcache.clear()
+            array, cold = time_call(current.generate_shadow_array, lights)
+            unused, steady = time_call(current.generate_shadow_array, lights, repeat=frames)
+            unused, windowed = time_call(current.generate_shadow_array, lights, view, repeat=frames)
+            row = [count, intensity, cold, steady, windowed, "%08x" % checksum(array)]
+            if reference:
+                expected, oldtime = time_call(old.generate_shadow_array, lights)
+                row += [oldtime, "ok" if checksum(expected) == checksum(array) else "MISMATCH"]
+            rows.append(row)
+            print("    %4d lights @ %3d   cold %8.3f ms   steady %8.3f ms   view %8.3f ms   %s" % tuple(row[:6])
+                  + ("   reference %9.3f ms  %s" % tuple(row[6:]) if reference else ""))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless benchmark for shader.py")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[20, 50, 100, 200])
+    parser.add_argument("--lights", type=int, nargs="*", default=[1, 10, 50])
+    parser.add_argument("--intensities", type=int, nargs="*", default=[50, 150, 400])
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--workers", type=int, default=1, help="processes used for the base lighting")
+    parser.add_argument("--no-reference", action="store_true", help="skip the recursive reference implementation")
+    parser.add_argument("--no-levels", action="store_true", help="skip the levels in the levels folder")
+    args = parser.parse_args()
+
+    levels = [random_level(size, size, seed=size) for size in args.sizes]
+    if not args.no_levels:
+        levels += [load_level(name) for name in sorted(os.listdir("levels"))]
+    mismatches = 0
+    for level in levels:
+        for row in bench_level(level, args.lights, args.intensities, args.frames, not args.no_reference, args.workers):
+            if row[-1] == "MISMATCH":
+                mismatches += 1
+    if not args.no_reference:
+        print("All results match the reference." if mismatches == 0 else str(mismatches) + " results do not match the reference!")
+    return mismatches
+
+if __name__ == "__main__":
+    raise SystemExit(1 if main() else 0)
@@ -0,0 +1,261 @@
+"""Headless benchmark and correctness check for pathfinding.py and the
+pathfinding methods of entities.py. Generates random mazes and weighted
+maps, times each pathfinder and checks its paths against a plain Dijkstra
+search. No window is opened.
+
+python pathbenchmark.py [--sizes 21 51 101] [--queries 50] [--seed 0] [--no-entities]
+"""
+import argparse
+import heapq
+import os
+import random
+import time
+import pathfinding
+
+WEIGHTS = { # mirrors the compressiondict in leveldata.py
+    "g": 1, # grass
+    "v": 0, # void
+    "a": 1, # air
+    "w": 0, # wall
+    "h": 1, # hidden wall
+    "i": 10000, # cave floor
+    "p": 0 # pond
+}
+
+class Tile():
+    """Stand-in for a block, holding only its weight."""
+    def __init__(self, weight):
+        self.weight = weight
+
+class BenchLevel():
+    """Stand-in for LevelData holding only what the pathfinding methods
+    of entities.py need. Pass the map name and a 2D list of weights."""
+    def __init__(self, name, grid):
+        self.name = name
+        self.solidmap = grid
+        self.width = len(grid[0])
+        self.height = len(grid)
+        self.rows = [[Tile(weight) for weight in row] for row in grid]
+        self.occupied = {}
+        self.pathsearch = pathfinding.SearchPicker(self.solidmap)
+
+def random_maze(width, height, seed=0):
+    """Depth first maze with one tile wide corridors and a few walls
+    knocked through, so that there is more than one route."""
+    rng = random.Random(seed)
+    grid = [[0] * width for i in range(height)]
+    stack = [(1, 1)]
+    grid[1][1] = 1
+    while stack:
+        x, y = stack[-1]
+        options = [(x + dx, y + dy, dx, dy) for dx, dy in ((2, 0), (-2, 0), (0, 2), (0, -2))
+                   if 0 < x + dx < width - 1 and 0 < y + dy < height - 1 and grid[y + dy][x + dx] == 0]
+        if len(options) == 0:
+            stack.pop()
+            continue
+        nx, ny, dx, dy = rng.choice(options)
+        grid[y + dy // 2][x + dx // 2] = 1
+        grid[ny][nx] = 1
+        stack.append((nx, ny))
+    for i in range(width * height // 20):
+        x = rng.randrange(1, width - 1)
+        y = rng.randrange(1, height - 1)
+        grid[y][x] = 1
+    return grid
+
+def random_weighted(width, height, seed=0):
+    """Grass, cave floor, hidden walls, walls and ponds, in clumps."""
+    rng = random.Random(seed)
+    grid = [[WEIGHTS["g"]] * width for i in range(height)]
+    for tile, count in (("i", 30), ("w", 40), ("p", 10), ("h", 15)):
+        for i in range(width * height * count // 4000):
+            x = rng.randrange(width)
+            y = rng.randrange(height)
+            for j in range(rng.randrange(4, 16)):
+                grid[y][x] = WEIGHTS[tile]
+                x = min(width - 1, max(0, x + rng.choice((-1, 0, 1))))
+                y = min(height - 1, max(0, y + rng.choice((-1, 0, 1))))
+    return grid
+
+def random_queries(grid, count, seed=0):
+    """Pairs of random passable tiles."""
+    rng = random.Random(seed)
+    spots = [(x, y) for y in range(len(grid)) for x in range(len(grid[0])) if grid[y][x] > 0]
+    if len(spots) < 2:
+        return []
+    return [tuple(rng.sample(spots, 2)) for i in range(count)]
+
+def dijkstra(grid, start, target, stats=None) -> "Cost of the cheapest path":
+    """Reference search with no heuristic. Returns None if there is no path."""
+    height = len(grid)
+    width = len(grid[0])
+    distances = {start: 0}
+    heap = [(0, start)]
+    while heap:
+        distance, (x, y) = heapq.heappop(heap)
+        if distance > distances[(x, y)]:
+            continue
+        if stats is not None:
+            stats["expanded"] = stats.get("expanded", 0) + 1
+        if (x, y) == target:
+            return distance
+        for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+            if 0 <= nx < width and 0 <= ny < height and grid[ny][nx] > 0:
+                ndistance = distance + grid[ny][nx]
+                if ndistance < distances.get((nx, ny), ndistance + 1):
+                    distances[(nx, ny)] = ndistance
+                    heapq.heappush(heap, (ndistance, (nx, ny)))
+    return None
+
+def check_path(grid, path, start, target) -> "Cost of the path":
+    """Raises ValueError if the path is not a walkable route from start to target."""
+    if path[0] != start or path[-1] != target:
+        raise ValueError("path does not join " + str(start) + " to " + str(target))
+    for (x, y), (nx, ny) in zip(path, path[1:]):
+        if abs(x - nx) + abs(y - ny) != 1 or grid[ny][nx] <= 0:
+            raise ValueError("invalid step from " + str((x, y)) + " to " + str((nx, ny)))
+    return pathfinding.path_cost(grid, path)
+
+class Result():
+    """Tally for one pathfinder on one map."""
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.time = 0
+        self.expanded = 0
+        self.optimal = 0
+        self.excess = 0
+        # total cost above the optimal cost, as a fraction of it
+        self.unreached = 0
+        # targets that can be reached but weren't
+        self.errors = 0
+        # impossible results, meaning there is a bug
+
+    def add(self, cost, best, elapsed, expanded):
+        self.queries += 1
+        self.time += elapsed
+        self.expanded += expanded
+        if cost is None and best is None:
+            self.optimal += 1
+        elif best is None:
+            self.errors += 1
+        elif cost is None:
+            self.unreached += 1
+        elif cost < best:
+            self.errors += 1
+        elif cost == best:
+            self.optimal += 1
+        else:
+            self.excess += (cost - best) / best
+
+    def row(self):
+        queries = max(1, self.queries)
+        return "    %-16s %8.3f ms/query %9.0f expanded   %3d/%-3d optimal   %6.2f%% over   %3d unreached   %s" % (
+            self.name, self.time * 1000 / queries, self.expanded / queries, self.optimal, self.queries,
+            100 * self.excess / queries, self.unreached, "ok" if self.errors == 0 else str(self.errors) + " ERRORS")
+
+def timed_search(search, grid, start, target, stats):
+    begin = time.perf_counter()
+    path = search(grid, start, target, stats=stats)
+    return path, time.perf_counter() - begin
+
+def bench_engines(level, queries, best):
+    """Runs the searches in pathfinding.py on every query."""
+    results = [Result("dijkstra"), Result("astar"), Result("jumppoint")]
+    hierarchy = level.pathsearch.get_hierarchy()
+    if hierarchy is not None:
+        results.append(Result("hierarchical"))
+    results.append(Result("flowfield"))
+    jumppoints = pathfinding.JumpPointMap(level.solidmap)
+    for (start, target), cost in zip(queries, best):
+        stats = {}
+        begin = time.perf_counter()
+        dijkstra(level.solidmap, start, target, stats)
+        results[0].add(cost, cost, time.perf_counter() - begin, stats["expanded"])
+        searches = [pathfinding.astar, jumppoints.find_path]
+        if hierarchy is not None:
+            searches.append(hierarchy.find_path)
+        for result, search in zip(results[1:], searches):
+            stats = {"expanded": 0}
+            path, elapsed = timed_search(search, level.solidmap, start, target, stats)
+            result.add(None if path is None else check_path(level.solidmap, path, start, target), cost, elapsed, stats["expanded"])
+        begin = time.perf_counter()
+        field = pathfinding.FlowField(level.solidmap, target)
+        path = [start]
+        while path[-1] != target and len(path) <= level.width * level.height:
+            step = field.next_step(path[-1])
+            if step == path[-1]:
+                break
+            path.append(step)
+        elapsed = time.perf_counter() - begin
+        expanded = sum(1 for distance in field.distances if distance != float("inf"))
+        results[-1].add(check_path(level.solidmap, path, start, target) if path[-1] == target else None, cost, elapsed, expanded)
+    return results
+
+def walk(entity, level, target, method) -> "List of positions":
+    """Moves an entity by calling one of its pathfinding methods every turn
+    until it reaches the target, stops moving or takes too long."""
+    path = [(entity.x, entity.y)]
+    for i in range(level.width * level.height):
+        if path[-1] == target:
+            break
+        entity.next_move = path[-1]
+        getattr(entity, method)(level, target, [])
+        if entity.next_move is None or tuple(entity.next_move) == path[-1]:
+            break
+        entity.x, entity.y = entity.next_move
+        path.append((entity.x, entity.y))
+    return path
+
+def bench_entities(level, queries, best, entities):
+    """Walks a bare Entity to each target with its pathfinding methods."""
+    results = []
+    for method in ("seek_pathfind", "simple_pathfind"):
+        result = Result(method)
+        for (start, target), cost in zip(queries, best):
+            entity = entities.Entity(start)
+            begin = time.perf_counter()
+            path = walk(entity, level, target, method)
+            elapsed = time.perf_counter() - begin
+            result.add(check_path(level.solidmap, path, start, target) if path[-1] == target else None, cost, elapsed, 0)
+        results.append(result)
+    return results
+
+def load_entities():
+    """entities.py loads its sprites on import, so it is only benchmarked
+    when they are available."""
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    try:
+        import entities
+    except Exception as error:
+        print("Skipping entities.py, it could not be imported: " + str(error))
+        return None
+    return entities
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless benchmark for pathfinding.py")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[21, 51, 101])
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-entities", action="store_true", help="skip the pathfinding methods of entities.py")
+    args = parser.parse_args()
+
+    entities = None if args.no_entities else load_entities()
+    errors = 0
+    for size in args.sizes:
+        for name, generate in (("maze", random_maze), ("weighted", random_weighted)):
+            level = BenchLevel(name + " " + str(size) + "x" + str(size), generate(size, size, args.seed + size))
+            queries = random_queries(level.solidmap, args.queries, args.seed + size)
+            best = [dijkstra(level.solidmap, start, target) for start, target in queries]
+            print(level.name)
+            results = bench_engines(level, queries, best)
+            if entities is not None:
+                results += bench_entities(level, queries, best, entities)
+            for result in results:
+                print(result.row())
+                errors += result.errors
+    print("No invalid paths found." if errors == 0 else str(errors) + " invalid paths found!")
+    return errors
+
+if __name__ == "__main__":
+    raise SystemExit(1 if main() else 0)
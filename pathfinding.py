@@ -0,0 +1,674 @@
+"""Pathfinding routines used by entities.py. Grids are 2D lists of tile
+weights in the same format as LevelData.solidmap, where a weight of 0 is
+impassable and anything higher is the cost of stepping onto that tile.
+Positions are (x, y) tuples and movement is in the four numpad directions.
+"""
+import heapq
+
+def astar(grid, start, target, blocked=(), stats=None) -> "List of positions":
+    """A* search over a weighted grid. Returns the cheapest path from start
+    to target, both included, or None if the target can't be reached.
+    Tiles in blocked (a set of positions) are treated as impassable.
+    If stats is a dictionary, its "expanded" count is increased by the
+    number of tiles expanded, and the blocked tiles the search ran into are
+    added to its "blocked" set.
+
+    The open list is a binary heap and g-scores are kept in a dictionary
+    indexed by tile, so each search costs O(n log n) in the number of tiles
+    explored. Nodes already expanded are skipped when popped again instead
+    of being removed from the heap.
+    """
+    height = len(grid)
+    width = len(grid[0])
+    start = tuple(start)
+    target = tuple(target)
+    if start == target:
+        return [start]
+    if not (0 <= target[0] < width and 0 <= target[1] < height):
+        return None
+    if grid[target[1]][target[0]] <= 0 or target in blocked:
+        return None
+    targetx, targety = target
+    startindex = start[1] * width + start[0]
+    targetindex = targety * width + targetx
+    gscores = {startindex: 0}
+    parents = {startindex: None}
+    closed = set()
+    heap = [(0, 0, startindex)]
+    # (f, h, index) - ties on f go to the tile closest to the target
+    while heap:
+        f, h, index = heapq.heappop(heap)
+        if index in closed:
+            continue
+        if index == targetindex:
+            return build_path(parents, index, width)
+        closed.add(index)
+        if stats is not None:
+            stats["expanded"] = stats.get("expanded", 0) + 1
+        g = gscores[index]
+        y, x = divmod(index, width)
+        for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+            if not (0 <= nx < width and 0 <= ny < height):
+                continue
+            weight = grid[ny][nx]
+            if weight <= 0:
+                continue
+            if (nx, ny) in blocked:
+                if stats is not None:
+                    stats.setdefault("blocked", set()).add((nx, ny))
+                continue
+            nindex = ny * width + nx
+            if nindex in closed:
+                continue
+            ng = g + weight
+            if ng < gscores.get(nindex, ng + 1):
+                gscores[nindex] = ng
+                parents[nindex] = index
+                h = abs(nx - targetx) + abs(ny - targety)
+                heapq.heappush(heap, (ng + h, h, nindex))
+    return None
+
+def repair_path(grid, path, start, target, blocked=(), depth=4, search=astar, stats=None) -> "List of positions":
+    """Reuses a path from a previous turn instead of searching from scratch.
+    Returns a path from start to target like astar(), or None if the
+    target can't be reached.
+
+    Steps already taken are dropped. If the target moved by at most depth
+    tiles, only the last depth steps are planned again and spliced onto the
+    old path, as long as the new tail costs no more than the old one plus
+    the distance the target moved. A full search is done instead if that
+    fails, if the entity left the path, or if a tile on the path has become
+    impassable or blocked. search is the function used for any new
+    searches, and takes the same arguments as astar(). stats is passed on
+    to every search.
+    """
+    start = tuple(start)
+    target = tuple(target)
+    if path is None or len(path) == 0:
+        return search(grid, start, target, blocked, stats)
+    if len(path) > 1 and path[1] == start:
+        path = path[1:]
+    if path[0] != start:
+        return search(grid, start, target, blocked, stats)
+    for x, y in path[1:]:
+        if grid[y][x] <= 0 or (x, y) in blocked:
+            return search(grid, start, target, blocked, stats)
+    if path[-1] != target:
+        if target in path:
+            path = path[:path.index(target) + 1]
+        elif abs(path[-1][0] - target[0]) + abs(path[-1][1] - target[1]) <= depth:
+            splice = max(0, len(path) - 1 - depth)
+            tail = search(grid, path[splice], target, blocked, stats)
+            shift = abs(path[-1][0] - target[0]) + abs(path[-1][1] - target[1])
+            if tail is None or path_cost(grid, tail) > path_cost(grid, path[splice:]) + shift:
+                # the new tail had to take a detour, so the old route is no good
+                return search(grid, start, target, blocked, stats)
+            path = path[:splice] + tail
+        else:
+            return search(grid, start, target, blocked, stats)
+    return remove_loops(path)
+
+def plan_step(grid, path, pathage, pathblocked, start, target, blocked=(), search=astar) -> "(next move, path, path age, path blocked)":
+    """One turn of Entity.seek_pathfind(). Repairs the kept path, or
+    plans from scratch once it is 4 turns old or once any of pathblocked
+    is no longer blocked. pathblocked holds the blocked tiles that the
+    searches behind the path ran into, so the path may be going around
+    them. Returns the tile to move to along with the new path, its age and
+    its blocked tiles.
+    """
+    if pathage >= 4 or any(tile not in blocked for tile in pathblocked):
+        # plan from scratch so detours don't stick around
+        path = None
+        pathage = 0
+        pathblocked = frozenset()
+    stats = {}
+    path = repair_path(grid, path, start, target, blocked, search=search, stats=stats)
+    pathblocked = pathblocked | stats.get("blocked", frozenset())
+    if path is not None and len(path) > 1:
+        return path[1], path, pathage + 1, pathblocked
+    return tuple(start), path, pathage + 1, pathblocked
+
+def plan_paths(task) -> "List of results":
+    """Worker for entities.PathfindPool. Takes a tuple of the level width,
+    its weights as one flat sequence, the blocked tiles, the target and a
+    list of requests (see Entity.pathfind_request()). Returns a
+    (next move, path, path age, path blocked) result for each request,
+    in order.
+    """
+    width, weights, blocked, target, requests = task
+    grid = [list(weights[i:i + width]) for i in range(0, len(weights), width)]
+    field = None
+    results = []
+    for request in requests:
+        if request[0] == "flow":
+            if field is None:
+                field = FlowField(grid, target, blocked)
+            results.append((field.next_step(request[1]), None, 0, frozenset()))
+        else:
+            kind, start, path, pathage, pathblocked = request
+            results.append(plan_step(grid, path, pathage, pathblocked, start, target, blocked))
+    return results
+
+def path_cost(grid, path):
+    """Total weight of the tiles stepped onto along a path."""
+    return sum(grid[y][x] for x, y in path[1:])
+
+def remove_loops(path) -> "List of positions":
+    """Cuts out any part of a path that comes back to a tile it already visited."""
+    output = []
+    seen = {}
+    for position in path:
+        if position in seen:
+            del output[seen[position] + 1:]
+            seen = {tile: i for i, tile in enumerate(output)}
+        else:
+            seen[position] = len(output)
+            output.append(position)
+    return output
+
+def build_path(parents, index, width) -> "List of positions":
+    """Walks a dictionary of parent indices back from index to the start."""
+    path = []
+    while index is not None:
+        y, x = divmod(index, width)
+        path.append((x, y))
+        index = parents[index]
+    path.reverse()
+    return path
+
+class FlowField():
+    """Distance map to a single target, shared by every entity seeking it.
+    Built with a reverse Dijkstra search from the target, so each tile holds
+    the cost of the cheapest path from it to the target, and an entity only
+    has to step to the neighbour with the lowest total cost.
+
+    Tiles in blocked are given a distance but never expanded, meaning that
+    entities standing on them can still follow the field while nobody else
+    is routed through them.
+    """
+    def __init__(self, grid, target, blocked=()):
+        self.grid = grid
+        self.height = len(grid)
+        self.width = len(grid[0])
+        self.target = tuple(target)
+        self.blocked = blocked
+        self.distances = [float("inf")] * (self.width * self.height)
+        targetx, targety = self.target
+        if not (0 <= targetx < self.width and 0 <= targety < self.height):
+            return
+        if grid[targety][targetx] <= 0 or self.target in blocked:
+            return
+        width = self.width
+        distances = self.distances
+        targetindex = targety * width + targetx
+        distances[targetindex] = 0
+        heap = [(0, targetindex)]
+        while heap:
+            distance, index = heapq.heappop(heap)
+            if distance > distances[index]:
+                continue
+            y, x = divmod(index, width)
+            if index != targetindex and (x, y) in blocked:
+                continue
+            distance += grid[y][x]
+            # stepping onto this tile costs its weight
+            for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+                if not (0 <= nx < width and 0 <= ny < self.height) or grid[ny][nx] <= 0:
+                    continue
+                nindex = ny * width + nx
+                if distance < distances[nindex]:
+                    distances[nindex] = distance
+                    heapq.heappush(heap, (distance, nindex))
+
+    def distance(self, position):
+        """Cost of the cheapest path from position to the target."""
+        x, y = position
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return float("inf")
+        return self.distances[y * self.width + x]
+
+    def next_step(self, position) -> "Position":
+        """Returns the neighbouring tile to move to from position to get
+        closer to the target, or position itself if there is no way there.
+        """
+        x, y = position
+        best = tuple(position)
+        if best == self.target:
+            return best
+        bestcost = float("inf")
+        for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+            if not (0 <= nx < self.width and 0 <= ny < self.height):
+                continue
+            weight = self.grid[ny][nx]
+            if weight <= 0 or (nx, ny) in self.blocked:
+                continue
+            cost = weight + self.distances[ny * self.width + nx]
+            if cost < bestcost:
+                best = (nx, ny)
+                bestcost = cost
+        return best
+
+class JumpPointMap():
+    """Jump point search over a grid, for levels made mostly of weight 1
+    tiles (grass, air and hidden walls). Straight runs of weight 1 tiles
+    are crossed in a single jump instead of expanding every tile on them,
+    so only the tiles where the cheapest path could turn go on the open
+    list. Tiles of any other weight, and the weight 1 tiles next to them,
+    are expanded one step at a time like in astar(), so paths are still
+    the cheapest ones on mixed maps.
+
+    It expands far fewer tiles than astar(), but every jump walks tile by
+    tile in Python, so it is only quicker where walls keep the jumps short.
+    On wide open levels it can take several times as long as astar(),
+    which is why SearchPicker only uses it when asked to.
+
+    Which tiles can be jumped over is worked out once, with a border of
+    unjumpable tiles around the grid so that no bounds checks are needed.
+    The grid is referenced rather than copied. Call update_tile() after
+    changing a tile's weight.
+    """
+    def __init__(self, grid):
+        self.grid = grid
+        self.height = len(grid)
+        self.width = len(grid[0])
+        self.stride = self.width + 2
+        self.open = bytearray(self.stride * (self.height + 2))
+        # 1 where a tile can be jumped over, indexed by (y + 1) * stride + x + 1
+        self.stops = bytearray(self.stride * (self.height + 2))
+        # 1 where a jump has to stop because a weighted tile is next to it
+        for y in range(self.height):
+            for x in range(self.width):
+                self.update_tile(x, y)
+
+    def update_tile(self, x, y):
+        index = (y + 1) * self.stride + x + 1
+        self.open[index] = self.grid[y][x] == 1
+        for nx, ny in ((x, y), (x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+            if 0 <= nx < self.width and 0 <= ny < self.height:
+                self.stops[(ny + 1) * self.stride + nx + 1] = any(
+                    0 <= ax < self.width and 0 <= ay < self.height and self.grid[ay][ax] > 1
+                    for ax, ay in ((nx - 1, ny), (nx + 1, ny), (nx, ny - 1), (nx, ny + 1)))
+
+    def find_path(self, grid, start, target, blocked=(), stats=None) -> "List of positions":
+        """Same as astar(), and grid is only accepted so that this method can
+        stand in for it - the grid given to the constructor is always used.
+        Blocked tiles are marked as unjumpable in self.open for the length
+        of the search, rather than copying it. Jumps don't keep track of
+        which blocked tiles they ran into, so every one on the grid is added
+        to the "blocked" set of stats.
+        """
+        cleared = []
+        for x, y in blocked:
+            if 0 <= x < self.width and 0 <= y < self.height:
+                if stats is not None:
+                    stats.setdefault("blocked", set()).add((x, y))
+                index = (y + 1) * self.stride + x + 1
+                if self.open[index]:
+                    self.open[index] = 0
+                    cleared.append(index)
+        try:
+            return self.search(tuple(start), tuple(target), blocked, stats)
+        finally:
+            for index in cleared:
+                self.open[index] = 1
+
+    def search(self, start, target, blocked, stats) -> "List of positions":
+        """Does the work of find_path() once blocked tiles are marked."""
+        grid = self.grid
+        width = self.width
+        height = self.height
+        stride = self.stride
+        if start == target:
+            return [start]
+        if not (0 <= target[0] < width and 0 <= target[1] < height):
+            return None
+        if grid[target[1]][target[0]] <= 0 or target in blocked:
+            return None
+        targetx, targety = target
+        targetindex = (targety + 1) * stride + targetx + 1
+        jumpable = self.open
+        stops = self.stops
+
+        def jump(index, step, side):
+            """Follows step from index and returns the first jump point, where
+            side is the step at right angles to it.
+            """
+            while True:
+                index += step
+                if not jumpable[index]:
+                    return None
+                if index == targetindex or stops[index]:
+                    return index
+                if (jumpable[index - side] and not jumpable[index - side - step]) or (jumpable[index + side] and not jumpable[index + side - step]):
+                    return index
+                if side == 1 and (jump(index, 1, stride) is not None or jump(index, -1, stride) is not None):
+                    # moving vertically, so look for jump points to either side
+                    return index
+
+        startindex = (start[1] + 1) * stride + start[0] + 1
+        gscores = {startindex: 0}
+        parents = {startindex: None}
+        directions = {startindex: 0}
+        # the step each tile was reached by, or 0 to expand all four ways
+        closed = set()
+        heap = [(0, 0, startindex)]
+        while heap:
+            f, h, index = heapq.heappop(heap)
+            if index in closed:
+                continue
+            if index == targetindex:
+                path = []
+                while index is not None:
+                    parent = parents[index]
+                    if parent is not None:
+                        step = stride if abs(parent - index) >= stride else 1
+                        step = step if parent > index else -step
+                        while index != parent:
+                            y, x = divmod(index, stride)
+                            path.append((x - 1, y - 1))
+                            index += step
+                    else:
+                        y, x = divmod(index, stride)
+                        path.append((x - 1, y - 1))
+                        index = None
+                path.reverse()
+                return path
+            closed.add(index)
+            if stats is not None:
+                stats["expanded"] = stats.get("expanded", 0) + 1
+            y, x = divmod(index, stride)
+            x -= 1
+            y -= 1
+            direction = directions[index]
+            if direction == 0 or grid[y][x] != 1:
+                steps = (-1, 1, -stride, stride)
+            elif abs(direction) == 1:
+                steps = (-stride, stride, direction)
+            else:
+                steps = (-1, 1, direction)
+            for step in steps:
+                nindex = index + step
+                ny, nx = divmod(nindex, stride)
+                nx -= 1
+                ny -= 1
+                if not (0 <= nx < width and 0 <= ny < height) or grid[ny][nx] <= 0 or (nx, ny) in blocked:
+                    continue
+                if grid[y][x] == 1 and grid[ny][nx] == 1:
+                    successor = jump(index, step, stride if abs(step) == 1 else 1)
+                    if successor is None:
+                        continue
+                    cost = abs(successor - index) // abs(step)
+                    successordirection = step
+                else:
+                    successor = nindex
+                    cost = grid[ny][nx]
+                    successordirection = 0
+                if successor in closed:
+                    continue
+                g = gscores[index] + cost
+                if g < gscores.get(successor, g + 1):
+                    gscores[successor] = g
+                    parents[successor] = index
+                    directions[successor] = successordirection
+                    sy, sx = divmod(successor, stride)
+                    h = abs(sx - 1 - targetx) + abs(sy - 1 - targety)
+                    heapq.heappush(heap, (g + h, h, successor))
+        return None
+
+def local_distances(grid, start, bounds, blocked=()) -> "Dictionary of costs":
+    """Dijkstra search from start that never leaves bounds, given as
+    (left, top, right, bottom). Returns the cost to every tile it reached.
+    """
+    left, top, right, bottom = bounds
+    start = tuple(start)
+    distances = {start: 0}
+    heap = [(0, start)]
+    while heap:
+        distance, (x, y) = heapq.heappop(heap)
+        if distance > distances[(x, y)]:
+            continue
+        for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+            if not (left <= nx < right and top <= ny < bottom):
+                continue
+            weight = grid[ny][nx]
+            if weight <= 0 or (nx, ny) in blocked:
+                continue
+            ndistance = distance + weight
+            if ndistance < distances.get((nx, ny), ndistance + 1):
+                distances[(nx, ny)] = ndistance
+                heapq.heappush(heap, (ndistance, (nx, ny)))
+    return distances
+
+class HierarchicalMap():
+    """HPA* abstraction of a grid for long range pathfinding on big levels.
+
+    The grid is split into square clusters. Wherever two neighbouring
+    clusters share a run of passable tiles along their border, an entrance
+    is placed on it (in the middle, or at both ends of long runs). The
+    costs between every pair of entrances in a cluster are worked out in
+    advance, so a long search only has to cross this much smaller graph and
+    then fill in the short stretches between entrances with astar().
+    Paths are not always the cheapest ones: on maps with clumps of heavy
+    tiles they cost a few percent more on average, and sometimes over 10%.
+
+    The grid is referenced rather than copied. Call update_tile() after
+    changing a tile's weight so the clusters around it are rebuilt.
+    """
+    def __init__(self, grid, clustersize=10):
+        self.grid = grid
+        self.height = len(grid)
+        self.width = len(grid[0])
+        self.clustersize = clustersize
+        self.columns = -(-self.width // clustersize)
+        self.rows = -(-self.height // clustersize)
+        self.borders = {}
+        # (cluster, cluster) -> list of entrance tile pairs crossing that border
+        self.nodes = {}
+        # cluster -> set of entrance tiles inside it
+        self.links = {}
+        # entrance tile -> {tile in the neighbouring cluster: cost}
+        self.intra = {}
+        # entrance tile -> {entrance tile in the same cluster: cost}
+        for cy in range(self.rows):
+            for cx in range(self.columns):
+                if cx + 1 < self.columns:
+                    self.build_border((cx, cy), (cx + 1, cy))
+                if cy + 1 < self.rows:
+                    self.build_border((cx, cy), (cx, cy + 1))
+        for cy in range(self.rows):
+            for cx in range(self.columns):
+                self.build_cluster((cx, cy))
+
+    def cluster_of(self, position):
+        return (position[0] // self.clustersize, position[1] // self.clustersize)
+
+    def cluster_bounds(self, cluster):
+        """Returns the (left, top, right, bottom) tiles covered by a cluster."""
+        left = cluster[0] * self.clustersize
+        top = cluster[1] * self.clustersize
+        return (left, top, min(self.width, left + self.clustersize), min(self.height, top + self.clustersize))
+
+    def neighbouring_clusters(self, cluster):
+        cx, cy = cluster
+        return [(x, y) for x, y in ((cx - 1, cy), (cx + 1, cy), (cx, cy - 1), (cx, cy + 1))
+                if 0 <= x < self.columns and 0 <= y < self.rows]
+
+    def build_border(self, first, second):
+        """Finds the entrances between two neighbouring clusters, where first
+        is the cluster to the left of or above second.
+        """
+        left, top, right, bottom = self.cluster_bounds(first)
+        if first[1] == second[1]:
+            pairs = [((right - 1, y), (right, y)) for y in range(top, bottom)]
+        else:
+            pairs = [((x, bottom - 1), (x, bottom)) for x in range(left, right)]
+        entrances = []
+        run = []
+        runweights = None
+        for pair in pairs + [None]:
+            weights = None
+            if pair is not None:
+                weights = (self.grid[pair[0][1]][pair[0][0]], self.grid[pair[1][1]][pair[1][0]])
+            if weights is not None and weights == runweights:
+                run.append(pair)
+                continue
+            # runs are split wherever the weights change, so that a cheap
+            # crossing is never hidden behind an expensive one
+            if len(run) >= 6:
+                entrances += [run[0], run[-1]]
+            elif len(run) > 0:
+                entrances.append(run[len(run) // 2])
+            run = []
+            runweights = None
+            if weights is not None and weights[0] > 0 and weights[1] > 0:
+                run = [pair]
+                runweights = weights
+        self.borders[(first, second)] = entrances
+
+    def build_cluster(self, cluster):
+        """Collects the entrances of a cluster and the costs between them."""
+        nodes = set()
+        for entrance in self.nodes.get(cluster, ()):
+            self.links.pop(entrance, None)
+            self.intra.pop(entrance, None)
+        for neighbour in self.neighbouring_clusters(cluster):
+            key = (cluster, neighbour) if cluster < neighbour else (neighbour, cluster)
+            for pair in self.borders[key]:
+                inside, outside = pair if self.cluster_of(pair[0]) == cluster else (pair[1], pair[0])
+                nodes.add(inside)
+                self.links.setdefault(inside, {})[outside] = self.grid[outside[1]][outside[0]]
+        self.nodes[cluster] = nodes
+        bounds = self.cluster_bounds(cluster)
+        for node in nodes:
+            distances = local_distances(self.grid, node, bounds)
+            self.intra[node] = {other: distances[other] for other in nodes if other != node and other in distances}
+
+    def update_tile(self, x, y):
+        """Rebuilds the cluster containing (x, y) and its neighbours."""
+        cluster = self.cluster_of((x, y))
+        for neighbour in self.neighbouring_clusters(cluster):
+            if cluster < neighbour:
+                self.build_border(cluster, neighbour)
+            else:
+                self.build_border(neighbour, cluster)
+        self.build_cluster(cluster)
+        for neighbour in self.neighbouring_clusters(cluster):
+            self.build_cluster(neighbour)
+
+    def find_path(self, grid, start, target, blocked=(), stats=None) -> "List of positions":
+        """Same as astar(), and grid is only accepted so that this method can
+        stand in for it - the grid given to the constructor is always used.
+        Short searches are passed straight to astar(). Blocked tiles are only
+        avoided when filling in the path, as they are expected to move.
+        """
+        start = tuple(start)
+        target = tuple(target)
+        startcluster = self.cluster_of(start)
+        targetcluster = self.cluster_of(target)
+        if startcluster == targetcluster or abs(start[0] - target[0]) + abs(start[1] - target[1]) <= 2 * self.clustersize:
+            return astar(self.grid, start, target, blocked, stats)
+        if not (0 <= target[0] < self.width and 0 <= target[1] < self.height):
+            return None
+        if self.grid[target[1]][target[0]] <= 0 or target in blocked:
+            return None
+        abstract = self.abstract_path(start, target, stats)
+        if abstract is None:
+            return None
+        path = [start]
+        for first, second in zip(abstract, abstract[1:]):
+            if abs(first[0] - second[0]) + abs(first[1] - second[1]) == 1 and second not in blocked:
+                path.append(second)
+                continue
+            segment = astar(self.grid, first, second, blocked, stats)
+            if segment is None:
+                # an entity is in the way of the planned route
+                return astar(self.grid, start, target, blocked, stats)
+            path += segment[1:]
+        return remove_loops(path)
+
+    def abstract_path(self, start, target, stats=None) -> "List of positions":
+        """A* over the entrances, with start and target temporarily linked to
+        the entrances of their own clusters. Returns the list of waypoints.
+        """
+        startcosts = local_distances(self.grid, start, self.cluster_bounds(self.cluster_of(start)))
+        startcosts = {node: startcosts[node] for node in self.nodes[self.cluster_of(start)] if node in startcosts and node != start}
+        targetcosts = local_distances(self.grid, target, self.cluster_bounds(self.cluster_of(target)))
+        targetweight = self.grid[target[1]][target[0]]
+        # walking a path backwards swaps which end's weight is paid
+        targetcosts = {node: targetcosts[node] - self.grid[node[1]][node[0]] + targetweight
+                       for node in self.nodes[self.cluster_of(target)] if node in targetcosts}
+        gscores = {start: 0}
+        parents = {start: None}
+        closed = set()
+        heap = [(0, start)]
+        while heap:
+            f, node = heapq.heappop(heap)
+            if node in closed:
+                continue
+            if node == target:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = parents[node]
+                path.reverse()
+                return path
+            closed.add(node)
+            if stats is not None:
+                stats["expanded"] = stats.get("expanded", 0) + 1
+            edges = []
+            if node == start:
+                edges += startcosts.items()
+            if node in self.intra:
+                edges += self.intra[node].items()
+                edges += self.links[node].items()
+            if node in targetcosts:
+                edges.append((target, targetcosts[node]))
+            for other, cost in edges:
+                if other in closed:
+                    continue
+                g = gscores[node] + cost
+                if g < gscores.get(other, g + 1):
+                    gscores[other] = g
+                    parents[other] = node
+                    heapq.heappush(heap, (g + abs(other[0] - target[0]) + abs(other[1] - target[1]), other))
+        return None
+
+class SearchPicker():
+    """Picks the search that Entity.seek_pathfind() uses on a grid, and
+    builds whatever that search needs the first time it is asked for.
+    Levels of hierarchysize tiles or more go through a HierarchicalMap.
+    Smaller levels use astar(), or a JumpPointMap if jumppoints is set,
+    which pathbenchmark.py can help decide.
+
+    The grid is referenced rather than copied. Call update_tile() after
+    changing a tile's weight.
+    """
+    def __init__(self, grid, jumppoints=False, hierarchysize=4096):
+        self.grid = grid
+        self.jumppoints = jumppoints
+        self.hierarchysize = hierarchysize
+        self.hierarchy = None
+        self.jumppointmap = None
+
+    def get_hierarchy(self) -> "HierarchicalMap":
+        """Returns the HierarchicalMap of a big grid, or None for a small one."""
+        if self.hierarchy is None and len(self.grid) * len(self.grid[0]) >= self.hierarchysize:
+            self.hierarchy = HierarchicalMap(self.grid)
+        return self.hierarchy
+
+    def get_search(self) -> "Search function":
+        """Returns a function that takes the same arguments as astar()."""
+        hierarchy = self.get_hierarchy()
+        if hierarchy is not None:
+            return hierarchy.find_path
+        if self.jumppoints:
+            if self.jumppointmap is None:
+                self.jumppointmap = JumpPointMap(self.grid)
+            return self.jumppointmap.find_path
+        return astar
+
+    def update_tile(self, x, y):
+        if self.hierarchy is not None:
+            self.hierarchy.update_tile(x, y)
+        if self.jumppointmap is not None:
+            self.jumppointmap.update_tile(x, y)
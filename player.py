@@ -129,9 +129,8 @@ class Player():
         """Checks if a particular tile has a solid block or entity on it."""
         if level.rows[position[1]][position[0]].weight == 0:
             return False
-        for entity in level.entities:
-            if entity.walkable == False and (entity.x, entity.y) == position:
-                return False
+        if level.is_blocked(position):
+            return False
         return True
 
     def update(self, game):
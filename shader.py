@@ -1,99 +1,392 @@
-import copy
+import hashlib
+import os
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
-rnd = lambda n: 3*round(n/3) + 1
+def propagate_region(task) -> "2D Array":
+    """Worker for Shader.propagate_parallel(). Takes a tuple of the dropoff
+    values, a region's transparency map, its lights in region coordinates
+    and its starting light values, and returns the flooded region.
+    """
+    dropoff, diagonaldropoff, transparency_map, lightlist, array = task
+    shader = Shader()
+    shader.dropoff = dropoff
+    shader.diagonaldropoff = diagonaldropoff
+    shader.arrayy, shader.arrayx = transparency_map.shape
+    shader.transparency_map = transparency_map
+    return shader.propagate(lightlist, array)
 
 class Shader():
     def __init__(self):
         self.dropoff = 35
         self.diagonaldropoff = round(self.dropoff * 1.4)
         self.upscale = False
+        self.upscalefactor = 3
+        self.smooth = False
+        self.lightcache = OrderedDict()
+        # individual light contributions, keyed by (intensity, x, y)
+        self.lightcachesize = 256
+        self.lastlights = set()
+        # (intensity, x, y) of last frame's lights, see combine_lights()
+        self.basecache = {}
+        # preprocessed base lighting, keyed by a hash of the level's lighting data
+        self.diskcache = True
+        self.cachedirectory = "cache"
+        self.workers = 1
+        # processes used for the base lighting of levels bigger than one region
+        self.regionsize = 64
+        self.smallflood = 2048
+        # floods covering at most this many tiles use propagate_small()
         
 
     def set_dimensions(self, level):
         """Sets default empty shader arrays and attributes
         based on level passed. Should be called on every load
-        and reload to avoid shadows breaking.
+        and reload to avoid shadows breaking. The preprocessed base
+        lighting is reused from memory, or from self.cachedirectory,
+        if the same level has been loaded before.
         """
         self.arrayx = level.width
         self.arrayy = level.height
-        self.transparency_map = level.transparency_map
-        self.baselighting, preprocesslights = level.generate_base_lighting()
-        for light in preprocesslights:
-            self.recurse(light, self.baselighting)
-        self.empty_scaled_array = []
-        for i in range(3 * self.arrayy):
-            self.empty_scaled_array.append([])
-            for j in range(3 * self.arrayx):
-                self.empty_scaled_array[i].append(None)
-        ...
-
-    def recurse(self, light, array):
-        """Recurses a light vector3 into adjacent tiles if possible."""
-        if light[0] <= 0:
+        self.transparency_map = np.array(level.transparency_map, dtype=bool)
+        self.lightcache.clear()
+        self.lastlights = set()
+        baselighting, preprocesslights = level.generate_base_lighting()
+        baselighting = np.array(baselighting, dtype=np.int32)
+        key = self.level_key(baselighting)
+        if key in self.basecache:
+            self.baselighting = self.basecache[key]
             return
-        if array[light[2]][light[1]] > light[0]:
-            return
-        array[light[2]][light[1]] = light[0]
-        if not self.transparency_map[light[2]][light[1]]:
-            return
-        if light[0] - self.dropoff > 0:
-            if light[1] > 0:
-                self.recurse([light[0] - self.dropoff, light[1] - 1, light[2]], array)
-            if light[1] < self.arrayx - 1:
-                self.recurse([light[0] - self.dropoff, light[1] + 1, light[2]], array)
-            if light[2] > 0:
-                self.recurse([light[0] - self.dropoff, light[1], light[2] - 1], array)
-            if light[2] < self.arrayy - 1:
-                self.recurse([light[0] - self.dropoff, light[1], light[2] + 1], array)
-        if light[0] - self.diagonaldropoff > 0:
-            if light[1] > 0 and light[2] > 0:
-                self.recurse([light[0] - self.diagonaldropoff, light[1] - 1, light[2] - 1], array)
-            if light[1] < self.arrayx - 1 and light[2] < self.arrayy - 1:
-                self.recurse([light[0] - self.diagonaldropoff, light[1] + 1, light[2] + 1], array)
-            if light[1] > 0 and light[2] < self.arrayy - 1:
-                self.recurse([light[0] - self.diagonaldropoff, light[1] - 1, light[2] + 1], array)
-            if light[1] < self.arrayx - 1 and light[2] > 0:
-                self.recurse([light[0] - self.diagonaldropoff, light[1] + 1, light[2] - 1], array)
-        return
-
-    def generate_shadow_array(self, lightlist) -> "2D Array":
+        path = os.path.join(self.cachedirectory, key + ".npy")
+        if self.diskcache:
+            try:
+                cached = np.load(path)
+                if cached.shape == baselighting.shape and cached.dtype == baselighting.dtype:
+                    self.baselighting = cached
+                    self.basecache[key] = self.baselighting
+                    return
+            except (OSError, ValueError, EOFError):
+                # missing, truncated or corrupt files are recomputed and overwritten
+                pass
+        if self.workers > 1 and (self.arrayx > self.regionsize or self.arrayy > self.regionsize):
+            self.baselighting = self.propagate_parallel(preprocesslights, baselighting)
+        else:
+            self.baselighting = self.propagate(preprocesslights, baselighting)
+        self.basecache[key] = self.baselighting
+        if self.diskcache:
+            temporary = path + "." + str(os.getpid()) + ".tmp"
+            try:
+                os.makedirs(self.cachedirectory, exist_ok=True)
+                with open(temporary, "wb") as f:
+                    np.save(f, self.baselighting)
+                os.replace(temporary, path)
+                # written under another name first, so an interrupted write
+                # never leaves a partial file where np.load() will find it
+            except OSError:
+                # the cache is only an optimisation, so a read-only folder is fine
+                try:
+                    os.remove(temporary)
+                except OSError:
+                    pass
+
+    def level_key(self, baselighting) -> "Hex String":
+        """Hashes everything the base lighting depends on: the light emitted
+        by each tile, which tiles are transparent, and the dropoff values.
+        """
+        digest = hashlib.sha1()
+        digest.update(np.array([self.arrayx, self.arrayy, self.dropoff, self.diagonaldropoff], dtype=np.int32).tobytes())
+        digest.update(baselighting.tobytes())
+        digest.update(np.packbits(self.transparency_map).tobytes())
+        return digest.hexdigest()
+
+    def propagate(self, lightlist, array, bounds=None):
+        """Floods a list of light vector3s in the format
+        [lightintensity, lightx, lighty] into a 2d NumPy array, in place.
+        Tiles are relaxed in rounds and only tiles that got brighter in the
+        last round are expanded in the next one, so the cost grows with the
+        lit area. Follows the dropoff and diagonaldropoff rules: light still
+        enters opaque tiles but never leaves them.
+
+        bounds is an optional (left, top, right, bottom) region of the level
+        that the array covers. Lights outside of it are ignored.
+        """
+        if bounds is None:
+            bounds = (0, 0, self.arrayx, self.arrayy)
+        left, top, right, bottom = bounds
+        if (right - left) * (bottom - top) <= self.smallflood:
+            return self.propagate_small(lightlist, array, bounds)
+        width = right - left + 2
+        grid = np.zeros((bottom - top + 2, width), dtype=np.int32)
+        grid[1:-1, 1:-1] = array
+        flat = grid.ravel()
+        transparency = np.pad(self.transparency_map[top:bottom, left:right], 1, constant_values=False).ravel()
+        # the border of the padded grid is opaque, so light reaching it
+        # is simply thrown away when the padding is sliced off again.
+        seeds = []
+        values = []
+        for light in lightlist:
+            if light[0] > 0 and left <= light[1] < right and top <= light[2] < bottom:
+                seeds.append((light[2] - top + 1) * width + light[1] - left + 1)
+                values.append(light[0])
+        if len(seeds) == 0:
+            return array
+        seeds = np.array(seeds)
+        values = np.array(values, dtype=np.int32)
+        keep = values >= flat[seeds]
+        seeds, values = seeds[keep], values[keep]
+        np.maximum.at(flat, seeds, values)
+        frontier = np.unique(seeds)
+        steps = (
+            (-1, self.dropoff), (1, self.dropoff),
+            (-width, self.dropoff), (width, self.dropoff),
+            (-width - 1, self.diagonaldropoff), (-width + 1, self.diagonaldropoff),
+            (width - 1, self.diagonaldropoff), (width + 1, self.diagonaldropoff)
+        )
+        while frontier.size > 0:
+            frontier = frontier[transparency[frontier]]
+            current = flat[frontier]
+            targets = []
+            lit = []
+            for step, dropoff in steps:
+                reach = current - dropoff
+                keep = reach > 0
+                targets.append(frontier[keep] + step)
+                lit.append(reach[keep])
+            targets = np.concatenate(targets)
+            lit = np.concatenate(lit)
+            brighter = lit > flat[targets]
+            targets, lit = targets[brighter], lit[brighter]
+            np.maximum.at(flat, targets, lit)
+            frontier = np.unique(targets)
+        array[:] = grid[1:-1, 1:-1]
+        return array
+
+    def propagate_small(self, lightlist, array, bounds=None):
+        """Same as propagate(), but floods one tile at a time in plain
+        Python, which is quicker than NumPy for the few hundred tiles that
+        the lights of a single frame usually reach. propagate() hands over
+        to this for regions of up to self.smallflood tiles.
+        """
+        if bounds is None:
+            bounds = (0, 0, self.arrayx, self.arrayy)
+        left, top, right, bottom = bounds
+        width = right - left + 2
+        grid = np.zeros((bottom - top + 2, width), dtype=np.int32)
+        grid[1:-1, 1:-1] = array
+        flat = grid.ravel().tolist()
+        transparency = np.zeros(grid.shape, dtype=bool)
+        transparency[1:-1, 1:-1] = self.transparency_map[top:bottom, left:right]
+        transparency = transparency.ravel().tolist()
+        # padded with an opaque border, the same as in propagate(). np.pad()
+        # takes longer than the whole flood for regions this small
+        steps = (
+            ((-1, 1, -width, width), self.dropoff),
+            ((-width - 1, -width + 1, width - 1, width + 1), self.diagonaldropoff)
+        )
+        stack = []
+        for light in lightlist:
+            if light[0] > 0 and left <= light[1] < right and top <= light[2] < bottom:
+                index = (light[2] - top + 1) * width + light[1] - left + 1
+                if light[0] >= flat[index]:
+                    flat[index] = light[0]
+                    if transparency[index]:
+                        stack.append(index)
+        while stack:
+            index = stack.pop()
+            value = flat[index]
+            for offsets, dropoff in steps:
+                reach = value - dropoff
+                if reach > 0:
+                    for offset in offsets:
+                        target = index + offset
+                        if reach > flat[target]:
+                            flat[target] = reach
+                            if transparency[target]:
+                                stack.append(target)
+                            # opaque tiles are lit but never spread light
+        array[:] = np.array(flat, dtype=np.int32).reshape(-1, width)[1:-1, 1:-1]
+        return array
+
+    def propagate_parallel(self, lightlist, array) -> "2D Array":
+        """Same as propagate() over the whole level, but the lights are
+        split into square regions of self.regionsize tiles which are
+        flooded in a pool of self.workers processes. Each region is flooded
+        on its own, together with a margin as wide as its brightest light
+        can reach, and the results are combined by taking the brightest
+        value of every tile.
+        """
+        regions = {}
+        for light in lightlist:
+            if light[0] > 0 and 0 <= light[1] < self.arrayx and 0 <= light[2] < self.arrayy:
+                regions.setdefault((light[1] // self.regionsize, light[2] // self.regionsize), []).append(light)
+        boundslist = []
+        tasks = []
+        for group in regions.values():
+            radius = self.light_radius(max(light[0] for light in group))
+            left = max(0, min(light[1] for light in group) - radius)
+            top = max(0, min(light[2] for light in group) - radius)
+            right = min(self.arrayx, max(light[1] for light in group) + radius + 1)
+            bottom = min(self.arrayy, max(light[2] for light in group) + radius + 1)
+            boundslist.append((left, top, right, bottom))
+            tasks.append((self.dropoff, self.diagonaldropoff, self.transparency_map[top:bottom, left:right],
+                          [[light[0], light[1] - left, light[2] - top] for light in group],
+                          array[top:bottom, left:right].copy()))
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(propagate_region, tasks))
+        for bounds, result in zip(boundslist, results):
+            window = array[bounds[1]:bounds[3], bounds[0]:bounds[2]]
+            np.maximum(window, result, out=window)
+        return array
+
+    def light_radius(self, intensity):
+        """Returns how many tiles away a light of a given intensity can reach."""
+        return max(0, (intensity - 1) // self.dropoff)
+
+    def light_bounds(self, light) -> "(left, top, right, bottom)":
+        """Returns the region of the level a light vector3 can reach."""
+        radius = self.light_radius(light[0])
+        return (max(0, light[1] - radius), max(0, light[2] - radius),
+                min(self.arrayx, light[1] + radius + 1), min(self.arrayy, light[2] + radius + 1))
+
+    def light_contribution(self, light) -> "2D Array, bounds":
+        """Returns the light map of a single light vector3 over the base
+        lighting, along with the (left, top, right, bottom) region it covers.
+        Maps are cached by (intensity, x, y), so lights that have not
+        moved or changed since the last frame are not flooded again.
+        """
+        key = (light[0], light[1], light[2])
+        if key in self.lightcache:
+            self.lightcache.move_to_end(key)
+            return self.lightcache[key]
+        bounds = self.light_bounds(light)
+        array = self.baselighting[bounds[1]:bounds[3], bounds[0]:bounds[2]].copy()
+        # starting from the base lighting stops the flood wherever it is already brighter
+        self.propagate([light], array, bounds)
+        self.lightcache[key] = (array, bounds)
+        if len(self.lightcache) > self.lightcachesize:
+            self.lightcache.popitem(last=False)
+        return array, bounds
+
+    def generate_shadow_array(self, lightlist, view=None) -> "2D Array":
         """Pass a list of vector3s in the format
         [lightintensity, lightx, lighty] to
-        return a 2d array of alpha values.
+        return a 2d NumPy array of light values.
+
+        If view is given as (left, top, width, height), only that part of
+        the level is computed and returned. If self.upscale is True, the
+        array is enlarged by self.upscalefactor with bilinear interpolation
+        to smoothen the lighting.
         """
-        array = [x[:] for x in self.baselighting]
-        # copying an array with [:] is significantly faster than copy.deepcopy()
+        if self.upscale == False:
+            return self.combine_lights(lightlist, view)
+        if view is None:
+            return self.upscalearray(self.combine_lights(lightlist))
+        # one extra tile on every side so the edges blend into their
+        # neighbours, clipped to the level and then padded with the nearest
+        # tile, which is how upscalearray() treats the edges of the level
+        factor = self.upscalefactor
+        window = np.zeros((view[3] * factor, view[2] * factor), dtype=np.int32)
+        left, top = max(0, view[0] - 1), max(0, view[1] - 1)
+        right, bottom = min(self.arrayx, view[0] + view[2] + 1), min(self.arrayy, view[1] + view[3] + 1)
+        if left >= right or top >= bottom:
+            return window
+        array = np.pad(self.combine_lights(lightlist, (left, top, right - left, bottom - top)), 1, mode="edge")
+        array = self.upscalearray(array)
+        x0, y0 = max(0, view[0]), max(0, view[1])
+        x1, y1 = min(self.arrayx, view[0] + view[2]), min(self.arrayy, view[1] + view[3])
+        if x0 < x1 and y0 < y1:
+            inside = array[(y0 - top + 1) * factor:(y1 - top + 1) * factor, (x0 - left + 1) * factor:(x1 - left + 1) * factor]
+            window[(y0 - view[1]) * factor:(y1 - view[1]) * factor, (x0 - view[0]) * factor:(x1 - view[0]) * factor] = inside
+        # tiles of the view outside of the level are left dark
+        return window
+
+    def combine_lights(self, lightlist, view=None) -> "2D Array":
+        """Combines each light with the base lighting by taking the
+        brightest value of every tile. Lights too far away to reach
+        the view are skipped entirely.
+
+        Only lights that were also there last frame use light_contribution()
+        and its cache. New lights, and lights that change every frame such
+        as explosions, are flooded together in one propagate() call instead,
+        since their floods would never be reused.
+        """
+        if view is None:
+            left, top, right, bottom = 0, 0, self.arrayx, self.arrayy
+            array = self.baselighting.copy()
+        else:
+            left, top = view[0], view[1]
+            right, bottom = left + view[2], top + view[3]
+            array = self.get_window(self.baselighting, *view)
+        lights = set()
+        new = []
         for light in lightlist:
-            self.recurse(light, array)
-        if self.upscale == True:
-            array = self.upscalearray(array)
+            if light[0] <= 0 or not (0 <= light[1] < self.arrayx and 0 <= light[2] < self.arrayy):
+                continue
+            # the base lighting already spreads at least this much light from here
+            if self.baselighting[light[2], light[1]] >= light[0]:
+                continue
+            radius = self.light_radius(light[0])
+            if light[1] + radius < left or light[1] - radius >= right or light[2] + radius < top or light[2] - radius >= bottom:
+                continue
+            key = (light[0], light[1], light[2])
+            lights.add(key)
+            if key in self.lastlights or key in self.lightcache:
+                self.blend(array, (left, top, right, bottom), *self.light_contribution(light))
+            else:
+                new.append(light)
+        self.lastlights = lights
+        if len(new) > 0:
+            # the flood of several lights is the brightest of their floods,
+            # and none of them reach outside the box around all of them
+            boxes = [self.light_bounds(light) for light in new]
+            bounds = (min(box[0] for box in boxes), min(box[1] for box in boxes),
+                      max(box[2] for box in boxes), max(box[3] for box in boxes))
+            flood = self.baselighting[bounds[1]:bounds[3], bounds[0]:bounds[2]].copy()
+            self.propagate(new, flood, bounds)
+            self.blend(array, (left, top, right, bottom), flood, bounds)
         return array
-    
+
+    def blend(self, array, view, contribution, bounds):
+        """Takes the brightest of array, which covers the (left, top, right,
+        bottom) view, and contribution, which covers bounds, where they overlap.
+        """
+        left, top, right, bottom = view
+        x0, y0 = max(left, bounds[0]), max(top, bounds[1])
+        x1, y1 = min(right, bounds[2]), min(bottom, bounds[3])
+        if x0 < x1 and y0 < y1:
+            window = array[y0 - top:y1 - top, x0 - left:x1 - left]
+            np.maximum(window, contribution[y0 - bounds[1]:y1 - bounds[1], x0 - bounds[0]:x1 - bounds[0]], out=window)
+
+    def get_window(self, array, left, top, width, height) -> "2D Array":
+        """Returns a width by height part of a shadow array with its top left
+        corner at (left, top). Tiles outside of the array are left dark.
+        """
+        window = np.zeros((height, width), dtype=np.int32)
+        arrayheight, arraywidth = array.shape
+        x0, y0 = max(0, left), max(0, top)
+        x1, y1 = min(arraywidth, left + width), min(arrayheight, top + height)
+        if x0 < x1 and y0 < y1:
+            window[y0 - top:y1 - top, x0 - left:x1 - left] = array[y0:y1, x0:x1]
+        return window
+
     def upscalearray(self, array) -> "2D Array":
-        """Upscales a shadowmap array by 3 in each dimension
-        and attempts to smoothen the values by applying
-        bilinear interpolation. This method works fine, in theory,
-        and the rendering is the problem.
+        """Upscales a shadowmap array by self.upscalefactor in each dimension
+        and smoothens the values with bilinear interpolation between tile
+        centres. Values are capped at 255 first, since anything brighter
+        is drawn the same anyway.
         """
-        output = [x[:] for x in self.empty_scaled_array]
-        for i in range(self.arrayy):
-            for j in range(self.arrayx):
-                output[i * 3 + 1][j * 3 + 1] = array[i][j]
-        ...
-        for i in range(self.arrayy * 3):
-            for j in range(self.arrayx * 3):
-                if output[i][j] == None:
-                    snapi = rnd(i)
-                    if snapi > self.arrayy * 3:
-                        snapi -= 3
-                    elif snapi < 0:
-                        snapi += 3
-                    remj = j % 3
-                    if 1 < j < self.arrayx * 3 - 2:
-                        if remj == 0:
-                            output[i][j] = int((output[snapi][j + 1] * 2 + output[snapi][j - 2]) / 3)
-                        elif remj == 1:
-                            output[i][j] = output[snapi][j]
-                        elif remj == 2:
-                            output[i][j] = int((output[snapi][j - 1] * 2 + output[snapi][j + 2]) / 3)
-        return output
\ No newline at end of file
+        factor = self.upscalefactor
+        array = np.clip(array, 0, 255).astype(np.float32)
+        height, width = array.shape
+        y = np.clip((np.arange(height * factor) + 0.5) / factor - 0.5, 0, height - 1)
+        x = np.clip((np.arange(width * factor) + 0.5) / factor - 0.5, 0, width - 1)
+        y0 = y.astype(int)
+        x0 = x.astype(int)
+        y1 = np.minimum(y0 + 1, height - 1)
+        x1 = np.minimum(x0 + 1, width - 1)
+        wy = (y - y0)[:, None]
+        wx = x - x0
+        top = array[y0][:, x0] * (1 - wx) + array[y0][:, x1] * wx
+        bottom = array[y1][:, x0] * (1 - wx) + array[y1][:, x1] * wx
+        return np.rint(top * (1 - wy) + bottom * wy).astype(np.int32)
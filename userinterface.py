@@ -22,6 +22,9 @@ class UserInterface():
         self.bsi_dimensions = (player.inventory.boxspritedim[0] * 3 + 4 * self.itemdisplayborders, player.inventory.boxspritedim[0] * 2 + self.itemdisplayborders * 3)
         self.baseitemsurface = pg.Surface(self.bsi_dimensions).convert_alpha()
         self.baseitemsurface.fill((0, 0, 0, 0))
+        self.itemdisplay = None
+        self.itemdisplaykey = None
+        # what the cached item display shows, see make_item_display()
 
 
     def calculate_hearts(self, player):
@@ -62,6 +65,20 @@ class UserInterface():
         surface.blit(lifetext, (20, 90))
         assets.screen.blit(surface, (0, assets.resolutiony))
 
+        slots = (inventory.upindex, inventory.leftindex, inventory.downindex, inventory.rightindex)
+        key = tuple(None if slot is None else inventory.items[slot].render_sprite for slot in slots)
+        if self.itemdisplay is None or key != self.itemdisplaykey:
+            self.itemdisplay = self.make_item_display(inventory)
+            self.itemdisplaykey = key
+        itemdisplay = self.itemdisplay
+        width, height = itemdisplay.get_size()
+        location = (int(assets.resolutionx * 3 / 4) - int(width / 2), assets.resolutiony + int((self.height - height) / 2))
+        assets.screen.blit(itemdisplay, location)
+
+    def make_item_display(self, inventory) -> "Item Display Surface":
+        """Draws the items assigned to the four slots, scaled to fit the UI.
+        render() keeps the result until the slots or their items change.
+        """
         itemdisplay = self.baseitemsurface.copy()
         bsd = inventory.boxspritedim[0]
         
@@ -87,7 +104,4 @@ class UserInterface():
         scaling = height / itemdisplay.get_height()
         width = int(scaling * self.bsi_dimensions[0])
         itemdisplay = pg.transform.scale(itemdisplay, (width, height))
-        location = (int(assets.resolutionx * 3 / 4) - int(width / 2), assets.resolutiony + int((self.height - height) / 2))
-        assets.screen.blit(itemdisplay, location)
-
-        
\ No newline at end of file
+        return itemdisplay
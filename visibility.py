@@ -0,0 +1,148 @@
+"""Line of sight and field of view over LevelData.transparency_map, a 2D
+list where True means light and sight pass through a tile.
+Positions are (x, y) tuples.
+"""
+import numpy as np
+
+QUADRANTS = ((0, -1, 1, 0), (0, 1, 1, 0), (1, 0, 0, 1), (-1, 0, 0, 1))
+# (x per row, y per row, x per column, y per column) for north, south, east and west
+
+def bresenham_line(start, end) -> "List of positions":
+    """Every tile on the line from start to end, both included, using
+    integer arithmetic only.
+    """
+    x, y = start
+    endx, endy = end
+    dx = abs(endx - x)
+    dy = -abs(endy - y)
+    stepx = 1 if x < endx else -1
+    stepy = 1 if y < endy else -1
+    error = dx + dy
+    line = [(x, y)]
+    while (x, y) != (endx, endy):
+        doubled = 2 * error
+        if doubled >= dy:
+            error += dy
+            x += stepx
+        if doubled <= dx:
+            error += dx
+            y += stepy
+        line.append((x, y))
+    return line
+
+class VisibilityCache():
+    """Answers line of sight and field of view queries against a
+    transparency map and remembers the answers until the map changes.
+
+    Sight is blocked if any tile strictly between the two ends is opaque,
+    so a wall can be seen but not seen through. The line is always traced
+    from the lower of the two positions, which makes the answer the same in
+    both directions and lets one entry serve both.
+    """
+    def __init__(self, transparency_map, maxsize=65536, fovcachesize=1024):
+        self.transparency_map = transparency_map
+        self.height = len(transparency_map)
+        self.width = len(transparency_map[0])
+        self.maxsize = maxsize
+        self.memo = {}
+        # (position, position) -> bool, with the lower position first
+        self.fovcachesize = fovcachesize
+        self.fovcache = {}
+        # (origin, radius) -> (mask, bounds), see field_of_view()
+
+    def has_los(self, start, end) -> bool:
+        start = tuple(start)
+        end = tuple(end)
+        if end < start:
+            start, end = end, start
+        key = (start, end)
+        try:
+            return self.memo[key]
+        except KeyError:
+            pass
+        visible = True
+        for x, y in bresenham_line(start, end)[1:-1]:
+            if not (0 <= x < self.width and 0 <= y < self.height) or not self.transparency_map[y][x]:
+                visible = False
+                break
+        if len(self.memo) >= self.maxsize:
+            self.memo.clear()
+        self.memo[key] = visible
+        return visible
+
+    def field_of_view(self, origin, radius) -> "(2D Array, bounds)":
+        """Symmetric shadowcasting from origin. Returns a boolean NumPy mask
+        of the tiles visible within radius and the (left, top, right, bottom)
+        tiles it covers, clipped to the level. Like has_los(), opaque tiles
+        are visible but hide what is behind them, and if a can see b then b
+        can see a. Results are cached until the map changes, so the mask
+        must not be modified.
+        """
+        origin = tuple(origin)
+        key = (origin, radius)
+        try:
+            return self.fovcache[key]
+        except KeyError:
+            pass
+        ox, oy = origin
+        left = max(0, ox - radius)
+        top = max(0, oy - radius)
+        right = min(self.width, ox + radius + 1)
+        bottom = min(self.height, oy + radius + 1)
+        mask = np.zeros((max(0, bottom - top), max(0, right - left)), dtype=bool)
+        if left <= ox < right and top <= oy < bottom:
+            mask[oy - top, ox - left] = True
+            for quadrant in QUADRANTS:
+                self.scan(mask, (left, top), origin, quadrant, radius, 1, (-1, 1), (1, 1))
+        if len(self.fovcache) >= self.fovcachesize:
+            self.fovcache.clear()
+        self.fovcache[key] = (mask, (left, top, right, bottom))
+        return self.fovcache[key]
+
+    def scan(self, mask, corner, origin, quadrant, radius, depth, startslope, endslope):
+        """Reveals one row of a quadrant and recurses into the rows behind
+        it. Slopes are (numerator, denominator) pairs so that only integer
+        arithmetic is used.
+        """
+        if depth > radius:
+            return
+        rowx, rowy, colx, coly = quadrant
+        # lowest column rounding ties up, highest rounding ties down
+        mincol = (2 * depth * startslope[0] + startslope[1]) // (2 * startslope[1])
+        maxcol = -((endslope[1] - 2 * depth * endslope[0]) // (2 * endslope[1]))
+        previous = None
+        # None before the first tile, then whether the last tile was opaque
+        for col in range(mincol, maxcol + 1):
+            x = origin[0] + rowx * depth + colx * col
+            y = origin[1] + rowy * depth + coly * col
+            inside = 0 <= x < self.width and 0 <= y < self.height
+            opaque = not inside or not self.transparency_map[y][x]
+            symmetric = col * startslope[1] >= depth * startslope[0] and col * endslope[1] <= depth * endslope[0]
+            if inside and (opaque or symmetric) and depth * depth + col * col <= radius * radius:
+                mask[y - corner[1], x - corner[0]] = True
+            if previous is True and not opaque:
+                startslope = (2 * col - 1, 2 * depth)
+            if previous is False and opaque:
+                self.scan(mask, corner, origin, quadrant, radius, depth + 1, startslope, (2 * col - 1, 2 * depth))
+            previous = opaque
+        if previous is False:
+            self.scan(mask, corner, origin, quadrant, radius, depth + 1, startslope, endslope)
+
+    def can_see(self, origin, radius, position) -> bool:
+        """Checks position against the cached field_of_view() of origin."""
+        mask, (left, top, right, bottom) = self.field_of_view(origin, radius)
+        x, y = position
+        return left <= x < right and top <= y < bottom and bool(mask[y - top, x - left])
+
+    def set_transparent(self, x, y, transparent):
+        """Changes one tile of the transparency map, forgetting every answer
+        if that changed anything.
+        """
+        if self.transparency_map[y][x] != transparent:
+            self.transparency_map[y][x] = transparent
+            self.invalidate()
+
+    def invalidate(self):
+        """Call after editing the transparency map directly."""
+        self.memo.clear()
+        self.fovcache.clear()